@@ -16,9 +16,12 @@ __docformat__ = 'restructuredtext en'
 __all__ = [
 ]
 
+import collections
 import os
 import shutil
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +49,22 @@ class WorkSpace:
         self.logger.log(logging.DEBUG, 'shutil.rmtree %s', self.name)
         shutil.rmtree(self.name)
 
+    def rename(self, name):
+        """move the work space, which must stay on the same file system"""
+        self.logger.log(logging.DEBUG, 'os.rename %s %s', self.name, name)
+        os.rename(self.name, name)
+        self.name = name
+
+    def empty(self):
+        """remove everything in the work space but keep the work space"""
+        self.logger.log(logging.DEBUG, 'emptying %s', self.name)
+        for entry in os.listdir(self.name):
+            path = os.path.join(self.name, entry)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
 
 class AllocationError(RainException):
     """Raised when we can't allocate a workspace."""
@@ -54,28 +73,430 @@ class AllocationError(RainException):
 
 class Location:
     '''
-    Brain dead allocator.  Assume local disk, single work space.
+    Work space allocator for one disk location.
+
+    Hands out up to *size* work spaces at once, or any number if *size*
+    is None.  A background thread keeps *spares* empty work spaces
+    created ahead of time, so that :py:meth:`next_workspace` is usually
+    just a pop from a list, and recycles removed work spaces by
+    emptying them into the spares, or removing them when there are
+    spares enough or they can't be emptied.  The thread is started when
+    first needed, and backs off from *backoff* up to *max_backoff*
+    seconds while creating or removing fails.
     '''
 
     name = None
-    workspace = None
+    prefix = 'WorkSpace'
+    backoff = 1
+    max_backoff = 60
 
-    def __init__(self, name='.', logger=logger):
+    def __init__(self, name='.', logger=logger, size=1, spares=0, prefix=None):
         self.name = name
-        self.workspace = None
+        self.logger = logger
+        self.size = size
+        self.spares = spares
+        if prefix is not None:
+            self.prefix = prefix
+
+        self.workspaces = set()
+        self.pending = 0
+        self.ready = collections.deque()
+        self.recycling = collections.deque()
+        self.serial = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+
+    @property
+    def workspace(self):
+        """the work space in use, when there is exactly one"""
+        return next(iter(self.workspaces)) if len(self.workspaces) == 1 else None
+
+    def _create(self):
+        while True:
+            with self.condition:
+                self.serial += 1
+                name = os.path.join(self.name, '{}-{}'.format(self.prefix, self.serial))
+
+            workspace = WorkSpace(name, logger=self.logger)
+            try:
+                workspace.create()
+            except FileExistsError:
+                continue
+
+            return workspace
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._maintain, name='location {}'.format(self.name))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _maintain(self):
+        delay = self.backoff
+        while True:
+            with self.condition:
+                while not (self.stopping or self.recycling
+                           or len(self.ready) < self._wanted()):
+                    self.condition.wait()
+
+                if self.stopping:
+                    return
+
+                workspace = self.recycling.popleft() if self.recycling else None
+
+            try:
+                if workspace is None:
+                    workspace = self._create()
+                elif len(self.ready) < self._wanted():
+                    try:
+                        workspace.empty()
+                    except OSError as e:
+                        self.logger.warning('%s: cannot empty %s, removing it: %s', self.name, workspace.name, e)
+                        workspace.remove()
+                        continue
+                else:
+                    workspace.remove()
+                    continue
+
+            except OSError as e:
+                # like a full disk, which won't clear up at once
+                self.logger.error('%s: %s, retrying in %s seconds', self.name, e, delay)
+                with self.condition:
+                    if not self.stopping:
+                        self.condition.wait(delay)
+                delay = min(delay * 2, self.max_backoff)
+                continue
+
+            delay = self.backoff
+            with self.condition:
+                self.ready.append(workspace)
+                self.condition.notify_all()
+
+    def _wanted(self):
+        """how many spares are worth having now"""
+        if self.size is None:
+            return self.spares
+
+        return min(self.spares, self.size - len(self.workspaces) - self.pending)
+
+    def next_workspace(self, name=None):
+        """
+        Allocate a work space, renamed to *name* if given.
+
+        :raises AllocationError: if *size* work spaces are in use.
+        """
+        with self.condition:
+            if self.size is not None and len(self.workspaces) + self.pending >= self.size:
+                raise AllocationError
+
+            self.pending += 1
+            workspace = self.ready.popleft() if self.ready else None
+            if self.spares:
+                self._start()
+                self.condition.notify_all()
 
-    def next_workspace(self):
-        if self.workspace:
-            raise AllocationError
+        spare = workspace
+        try:
+            if workspace is None:
+                if name is None:
+                    workspace = self._create()
+                else:
+                    workspace = WorkSpace(name, logger=self.logger)
+                    workspace.create()
+            elif name is not None:
+                workspace.rename(name)
 
-        self.workspace = WorkSpace(os.path.join(self.name, 'WorkSpace'))
-        self.workspace.create()
-        return self.workspace
+        except:
+            with self.condition:
+                self.pending -= 1
+                if spare:
+                    self.ready.append(spare)
+                self.condition.notify_all()
+            raise
+
+        with self.condition:
+            self.pending -= 1
+            self.workspaces.add(workspace)
+
+        return workspace
+
+    def release(self, workspace):
+        """stop counting *workspace* as in use, leaving it on disk"""
+        with self.condition:
+            if workspace not in self.workspaces:
+                raise AllocationError
+
+            self.workspaces.discard(workspace)
+            self.condition.notify_all()
 
     def remove_workspace(self, workspace):
-        if workspace is not self.workspace:
-            raise AllocationError
+        """release *workspace* and recycle it in the background"""
+        self.release(workspace)
+
+        if not self.spares:
+            workspace.remove()
+            return
+
+        with self.condition:
+            self.recycling.append(workspace)
+            self._start()
+            self.condition.notify_all()
+
+    def close(self):
+        """stop the background thread and remove the spares"""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+        while self.recycling:
+            self.recycling.popleft().remove()
+
+        while self.ready:
+            self.ready.popleft().remove()
+
+
+def free_bytes(path):
+    """bytes available to unprivileged users on *path*'s file system"""
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+class DiskLoad:
+    '''
+    Recent utilization of block devices, from the io_ticks column of
+    */proc/diskstats*.  Samples are taken at most every *interval*
+    seconds and utilization is the fraction of the time between the
+    last two samples that the device was busy.  Devices which don't
+    appear there, like tmpfs or nfs, are never busy.
+    '''
+
+    def __init__(self, diskstats='/proc/diskstats', interval=1.0):
+        self.diskstats = diskstats
+        self.interval = interval
+        self.sample = None
+        self.when = None
+        self.utilization = {}
+
+    def read(self):
+        ticks = {}
+        try:
+            with open(self.diskstats) as diskstats:
+                for line in diskstats:
+                    fields = line.split()
+                    if len(fields) >= 13:
+                        ticks[(int(fields[0]), int(fields[1]))] = int(fields[12])
+        except IOError:
+            pass
+
+        return ticks
+
+    def refresh(self):
+        now = time.time()
+        if self.when is not None and now - self.when < self.interval:
+            return
+
+        sample = self.read()
+        if self.sample is not None:
+            elapsed = (now - self.when) * 1000.0
+            self.utilization = dict((device, min(1.0, (ticks - self.sample.get(device, ticks)) / elapsed))
+                                    for device, ticks in sample.items())
+
+        self.sample = sample
+        self.when = now
+
+    def busy(self, path):
+        self.refresh()
+        dev = os.stat(path).st_dev
+        return self.utilization.get((os.major(dev), os.minor(dev)), 0.0)
+
+
+class Scheduler:
+    '''
+    Chooses among several :py:class:`Location` roots, typically on
+    different volumes, for each new build.
+
+    Locations with less than *min_free* bytes free, or with *size*
+    builds already assigned, are passed over.  Of the rest, we prefer
+    the device with the fewest builds assigned, then the location with
+    the fewest, then the least busy device according to *load*, then
+    the most free space.
+    '''
+
+    def __init__(self, locations, min_free=0, load=None):
+        self.locations = list(locations)
+        self.min_free = min_free
+        self.load = DiskLoad() if load is None else load
+        self.lock = threading.Lock()
+        self.assigned = collections.Counter()
+
+    def pick(self):
+        """
+        Assign a build to a location.  Call :py:meth:`release` when
+        the build is done.
+
+        :raises AllocationError: when no location will do.
+        """
+        with self.lock:
+            devices = dict((location, os.stat(location.name).st_dev) for location in self.locations)
+            per_device = collections.Counter()
+            for location, count in self.assigned.items():
+                per_device[devices[location]] += count
+
+            candidates = []
+            for order, location in enumerate(self.locations):
+                if location.size is not None and self.assigned[location] >= location.size:
+                    continue
+
+                free = free_bytes(location.name)
+                if free < self.min_free:
+                    logger.debug('%s has only %s bytes free', location.name, free)
+                    continue
+
+                busy = round(self.load.busy(location.name), 1)
+                candidates.append((per_device[devices[location]], self.assigned[location], busy, -free, order,
+                                   location))
+
+            if not candidates:
+                raise AllocationError
+
+            location = min(candidates)[-1]
+            self.assigned[location] += 1
+            return location
+
+    def release(self, location):
+        with self.lock:
+            self.assigned[location] -= 1
+            if self.assigned[location] <= 0:
+                del self.assigned[location]
+
+    def close(self):
+        for location in self.locations:
+            location.close()
+
+
+def mem_available(meminfo='/proc/meminfo'):
+    """MemAvailable from *meminfo* in bytes, or None if it can't be read"""
+    try:
+        with open(meminfo) as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+
+    return None
+
+
+class MemoryRoot:
+    '''
+    A tmpfs directory for builds expected to fit in memory.
+
+    :py:meth:`claim` hands out a directory under *name* for a build
+    estimated at *estimate* bytes only while the claimed estimates stay
+    within *budget*, the tmpfs has room, and the system would keep at
+    least *reserve* bytes of MemAvailable.  Otherwise the build should
+    go to disk.  So builds fall back to disk on their own as memory
+    pressure rises.
+    '''
+
+    def __init__(self, name, budget, reserve=1024 ** 3, logger=logger, meminfo='/proc/meminfo'):
+        self.name = name
+        self.budget = budget
+        self.reserve = reserve
+        self.logger = logger
+        self.meminfo = meminfo
+        self.lock = threading.Lock()
+        self.claimed = {}
+
+    def claim(self, stamp, estimate):
+        """
+        :return: a new directory for *stamp*, or None if it should go to disk.
+        """
+        if estimate is None:
+            return None
+
+        with self.lock:
+            committed = sum(self.claimed.values())
+            if committed + estimate > self.budget:
+                self.logger.debug('%s: %s would exceed the budget of %s', self.name, estimate, self.budget)
+                return None
+
+            if free_bytes(self.name) < estimate:
+                self.logger.debug('%s: not enough room for %s', self.name, estimate)
+                return None
+
+            available = mem_available(self.meminfo)
+            if available is not None and available - estimate < self.reserve:
+                self.logger.debug('%s: memory pressure, %s available', self.name, available)
+                return None
+
+            path = os.path.join(self.name, stamp)
+            os.mkdir(path)
+            self.claimed[path] = estimate
+            return path
+
+    def release(self, path):
+        with self.lock:
+            self.claimed.pop(path, None)
+
+
+class Admission:
+    '''
+    A gate for the build loops which holds off starting another build
+    while the one minute load average is over *max_load*, MemAvailable
+    is under *min_memory* bytes or any of *paths* has under *min_free*
+    bytes free.  Unset thresholds aren't checked.
+
+    :py:meth:`wait` checks again after *backoff* seconds, doubling each
+    time up to *max_backoff*.
+    '''
+
+    def __init__(self, logger=logger, max_load=None, min_memory=None, min_free=None, paths=('.',),
+                 backoff=5, max_backoff=60, meminfo='/proc/meminfo', loadavg=os.getloadavg, sleep=time.sleep):
+        self.logger = logger
+        self.max_load = max_load
+        self.min_memory = min_memory
+        self.min_free = min_free
+        self.paths = paths
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.meminfo = meminfo
+        self.loadavg = loadavg
+        self.sleep = sleep
+
+    def reasons(self):
+        """:return: why a build shouldn't start now, if it shouldn't"""
+        reasons = []
+        if self.max_load is not None:
+            load = self.loadavg()[0]
+            if load > self.max_load:
+                reasons.append('load average {:.2f}'.format(load))
+
+        if self.min_memory is not None:
+            available = mem_available(self.meminfo)
+            if available is not None and available < self.min_memory:
+                reasons.append('{} bytes of memory available'.format(available))
+
+        if self.min_free is not None:
+            for path in self.paths:
+                free = free_bytes(path)
+                if free < self.min_free:
+                    reasons.append('{} bytes free on {}'.format(free, path))
+
+        return reasons
 
-        self.workspace.remove()
-        self.workspace = None
+    def wait(self):
+        delay = self.backoff
+        while True:
+            reasons = self.reasons()
+            if not reasons:
+                return
 
+            self.logger.info('holding off the next build for %s seconds: %s', delay, ', '.join(reasons))
+            self.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
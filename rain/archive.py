@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+Compact archives of old builds: their status, logs and selected
+artifacts in a compressed tar file beside where the tree used to be.
+
+We compress with the zstd command, using all cores, when there is one,
+then with the zstandard module, and fall back to gzip.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import contextlib
+import fnmatch
+import os
+import shutil
+import subprocess
+import tarfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+suffixes = ['.tar.zst', '.tar.gz']
+
+# always archived, along with whatever patterns the caller asks for
+bookkeeping = ['.rain', '.rain.json', '.rain.stages', 'Log-*']
+
+def build_name(filename):
+    for suffix in suffixes:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+
+    return None
+
+def selected(dir, patterns):
+    """relative names under *dir* matching the bookkeeping or *patterns*"""
+    patterns = bookkeeping + list(patterns)
+    names = []
+    for dirpath, dirnames, filenames in os.walk(dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            relname = os.path.relpath(os.path.join(dirpath, name), dir)
+            if any(fnmatch.fnmatch(relname, pattern) for pattern in patterns):
+                names.append(relname)
+
+    return names
+
+@contextlib.contextmanager
+def compressor(filename):
+    """
+    yield a writable binary stream which ends up zstd compressed in
+    *filename*
+    """
+    if shutil.which('zstd'):
+        with open(filename, 'wb') as out:
+            proc = subprocess.Popen(['zstd', '-q', '-T0', '-c'], stdin=subprocess.PIPE, stdout=out)
+            try:
+                yield proc.stdin
+            finally:
+                proc.stdin.close()
+                if proc.wait():
+                    raise IOError('zstd failed compressing {}'.format(filename))
+
+    else:
+        with open(filename, 'wb') as out:
+            cctx = zstandard.ZstdCompressor(threads=-1)
+            with cctx.stream_writer(out, closefd=False) as stream:
+                yield stream
+
+@contextlib.contextmanager
+def decompressor(filename):
+    """
+    yield a readable binary stream of the tar inside *filename*
+
+    :raises IOError: if there is neither the zstd command nor zstandard.
+    """
+    if filename.endswith('.tar.zst') and shutil.which('zstd'):
+        proc = subprocess.Popen(['zstd', '-q', '-d', '-c', filename], stdout=subprocess.PIPE)
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+    elif zstandard:
+        with open(filename, 'rb') as f:
+            with zstandard.ZstdDecompressor().stream_reader(f) as stream:
+                yield stream
+
+    else:
+        raise IOError('{} needs zstandard or the zstd command'.format(filename))
+
+def archive(dir, patterns=()):
+    """
+    Write the bookkeeping files and files matching *patterns* under
+    *dir* to a compressed tar file beside it.
+
+    :return: the archive's file name.
+    """
+    filename = dir + ('.tar.zst' if shutil.which('zstd') or zstandard else '.tar.gz')
+    partial = filename + '.partial'
+    names = selected(dir, patterns)
+
+    def add(tar):
+        for name in names:
+            tar.add(os.path.join(dir, name), arcname=name, recursive=False)
+
+    try:
+        if filename.endswith('.tar.gz'):
+            with tarfile.open(partial, 'w:gz') as tar:
+                add(tar)
+        else:
+            with compressor(partial) as stream:
+                with tarfile.open(fileobj=stream, mode='w|') as tar:
+                    add(tar)
+
+    except:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    os.rename(partial, filename)
+    return filename
+
+def extract(filename, dir):
+    """restore the archive *filename* into the new directory *dir*"""
+    if filename.endswith('.tar.gz'):
+        os.mkdir(dir)
+        with tarfile.open(filename, 'r:gz') as tar:
+            tar.extractall(dir)
+        return
+
+    with decompressor(filename) as stream:
+        os.mkdir(dir)
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            tar.extractall(dir)
+
+def read_member(filename, name):
+    """the contents of *name* in the archive *filename*, or None"""
+    def find(tar):
+        for member in tar:
+            if member.name == name:
+                return tar.extractfile(member).read()
+        return None
+
+    if filename.endswith('.tar.gz'):
+        with tarfile.open(filename, 'r:gz') as tar:
+            return find(tar)
+
+    with decompressor(filename) as stream:
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            return find(tar)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+Benchmarks of rain's own overhead: workspace management, the build
+index, logging and the build loop itself, with a no-op rain.mk and
+synthetic trees so that nothing touches the network.
+
+Run as ``python -m rain.bench`` and compare the json it writes between
+versions.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+import rain.index
+import rain.logpipe
+import rain.main
+
+noop_mk = """#!/bin/sh
+exit 0
+"""
+
+def make_tree(root, files, depth, total_bytes):
+    """
+    Create *files* files spread over directories *depth* deep under
+    *root*, *total_bytes* in all.
+    """
+    os.makedirs(root)
+    size = total_bytes // files if files else 0
+    data = b'x' * size
+    fanout = 8
+    for i in range(files):
+        parts = []
+        n = i
+        for level in range(depth):
+            parts.append('d{}'.format(n % fanout))
+            n //= fanout
+        dirname = os.path.join(root, *parts)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        with open(os.path.join(dirname, 'f{}'.format(i)), 'wb') as f:
+            f.write(data)
+
+def make_builds(count, tree=None):
+    """create *count* finished build directories in the current directory"""
+    names = []
+    for i in range(count):
+        name = '2014-01-01T00:00:00.{:06d}'.format(i)
+        if tree:
+            make_tree(name, **tree)
+        else:
+            os.mkdir(name)
+
+        with open(os.path.join(name, '.rain'), 'w') as dotrain:
+            dotrain.write('built\n')
+        names.append(name)
+
+    return names
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    function(*args, **kwargs)
+    return time.time() - start
+
+class Bench:
+    """
+    Runs each benchmark in a fresh scratch directory under *tmpdir*.
+    """
+
+    def __init__(self, logger, options, tmpdir=None):
+        self.logger = logger
+        self.options = options
+        self.tmpdir = tmpdir
+        self.tree = {'files': options.files, 'depth': options.depth, 'total_bytes': options.bytes}
+
+    def scratch(self, function):
+        savedir = os.getcwd()
+        scratch = tempfile.mkdtemp(dir=self.tmpdir, prefix='rain-bench-')
+        os.chdir(scratch)
+        try:
+            return function()
+        finally:
+            os.chdir(savedir)
+            shutil.rmtree(scratch)
+
+    def area(self, reaper=None):
+        return rain.main.WorkArea(self.logger, reaper=reaper)
+
+    def bench_keep(self):
+        results = {}
+        for mode in ['sync', 'reaper']:
+            def run():
+                make_builds(self.options.builds, self.tree)
+                reaper = None
+                if mode == 'reaper':
+                    reaper = rain.main.Reaper(self.logger, ionice=0)
+                    reaper.start()
+                area = self.area(reaper)
+                seconds = timed(area.keep, 1)
+                if reaper:
+                    results['reaper_drain'] = timed(reaper.stop)
+                return seconds
+            results[mode] = self.scratch(run)
+
+        return results
+
+    def bench_clear(self):
+        results = {}
+        for mode in ['sync', 'reaper']:
+            def run():
+                make_tree('existing', **self.tree)
+                reaper = None
+                if mode == 'reaper':
+                    reaper = rain.main.Reaper(self.logger, ionice=0)
+                    reaper.start()
+                wd = rain.main.WorkingDirectory(self.logger, 'existing', 'true', reaper=reaper)
+                seconds = timed(wd.clear)
+                if reaper:
+                    reaper.stop()
+                return seconds
+            results[mode] = self.scratch(run)
+
+        return results
+
+    def bench_raindirs(self):
+        def run():
+            make_builds(self.options.many)
+            area = self.area()
+            results = {'scan': timed(area.scan)}
+            results['reindex'] = timed(area.reindex)
+            start = time.time()
+            for i in range(self.options.repeat):
+                area.raindirs()
+            results['index'] = (time.time() - start) / self.options.repeat
+            results['last_built'] = timed(area.last_built)
+            return results
+
+        return self.scratch(run)
+
+    def bench_log(self):
+        chunk = (b'compiling something or other with a reasonably long command line\n' * 1024)
+        chunks = max(1, int(self.options.log_mb * 1024 * 1024) // len(chunk))
+        results = {}
+        for compress in [None, 'gzip', 'zstd']:
+            if compress == 'zstd' and not rain.logpipe.zstandard:
+                continue
+
+            def run():
+                log = rain.logpipe.LogPipe('Log', compress=compress)
+                start = time.time()
+                with log:
+                    for i in range(chunks):
+                        log.write(chunk)
+                seconds = time.time() - start
+                return {
+                    'mb_per_second': chunks * len(chunk) / (1024 * 1024) / seconds,
+                    'ratio': os.path.getsize(log.filename) / float(chunks * len(chunk)),
+                }
+            results[compress or 'none'] = self.scratch(run)
+
+        return results
+
+    def bench_loop(self):
+        def run():
+            with open('rain.mk', 'w') as mkfile:
+                mkfile.write(noop_mk)
+            os.chmod('rain.mk', stat.S_IRWXU)
+
+            area = self.area()
+            options = argparse.Namespace(count=self.options.loops, jobs=1, keep=-1)
+            seconds = timed(rain.main.build_loop, area, options, os.path.abspath('rain.mk'))
+            return {'per_build': seconds / self.options.loops}
+
+        return self.scratch(run)
+
+    benchmarks = ['keep', 'clear', 'raindirs', 'log', 'loop']
+
+    def run(self, names=None):
+        results = {}
+        for name in names or self.benchmarks:
+            self.logger.info('benchmarking %s...', name)
+            results[name] = getattr(self, 'bench_' + name)()
+            self.logger.debug('%s: %s', name, results[name])
+
+        return results
+
+
+def main(args=None):
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%dT%H:%M:%S%z')
+    logger = logging.getLogger()
+
+    options = _parse_args(args)
+    logger.setLevel(logging.DEBUG if options.verbose else logging.WARNING)
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': dict((key, value) for key, value in vars(options).items()
+                           if key not in ['output', 'verbose', 'benchmark']),
+        'results': Bench(logger, options, tmpdir=options.tmpdir).run(options.benchmark),
+    }
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    return False
+
+
+def _parse_args(args=None):
+    """
+    Parses the command line arguments.
+
+    :return: Namespace with arguments.
+    :rtype: Namespace
+    """
+    parser = argparse.ArgumentParser(description='benchmark rain\'s own overhead.')
+
+    parser.add_argument('benchmark', nargs='*', default=[],
+                        help='which benchmarks to run, of {}. [default: all]'.format(', '.join(Bench.benchmarks)))
+
+    parser.add_argument('--files', type=int, default=1000,
+                        help='files in each synthetic tree. [default: %(default)s]')
+
+    parser.add_argument('--depth', type=int, default=3,
+                        help='directory depth of each synthetic tree. [default: %(default)s]')
+
+    parser.add_argument('--bytes', type=int, default=10 * 1024 * 1024,
+                        help='total bytes in each synthetic tree. [default: %(default)s]')
+
+    parser.add_argument('--builds', type=int, default=5,
+                        help='synthetic build trees for keep. [default: %(default)s]')
+
+    parser.add_argument('--many', type=int, default=5000,
+                        help='empty build directories for raindirs. [default: %(default)s]')
+
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='repetitions of quick measurements. [default: %(default)s]')
+
+    parser.add_argument('--log-mb', type=float, default=64,
+                        help='megabytes of log to write. [default: %(default)s]')
+
+    parser.add_argument('--loops', type=int, default=20,
+                        help='no-op builds for the loop benchmark. [default: %(default)s]')
+
+    parser.add_argument('--tmpdir', default=None,
+                        help='where to make scratch directories. [default: system temporary directory]')
+
+    parser.add_argument('-o', '--output', default=None,
+                        help='write json results here. [default: stdout]')
+
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='Be more verbose. (can be repeated)')
+
+    options = parser.parse_args(args)
+    for name in options.benchmark:
+        if name not in Bench.benchmarks:
+            parser.error('unknown benchmark {}'.format(name))
+
+    return options
+
+if __name__ == '__main__':
+    sys.exit(main())
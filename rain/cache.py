@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+Fingerprints of populated trees, so that a build whose inputs haven't
+changed since an earlier build can be skipped, and the cache directory
+builds share for compilers and downloads.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import fnmatch
+import hashlib
+import os
+import stat
+import threading
+import time
+
+chunk_size = 1024 * 1024
+
+# digests not used for this long are dropped from the index
+digest_lifetime = 7 * 24 * 60 * 60
+
+# where in a build ccache logs a line for each compilation
+statslog = '.rain.ccache-stats'
+
+# ccache's statistics counted as hits and misses
+hit_statistics = ['direct_cache_hit', 'preprocessed_cache_hit']
+miss_statistics = ['cache_miss']
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def fingerprint(path, index=None, ignore=(), extra=()):
+    """
+    Return a digest of the names, modes and contents of the files under
+    *path*.  Top level names which match any of the :py:mod:`fnmatch`
+    patterns in *ignore* are left out and the files named in *extra*,
+    like the build script, are put in.
+
+    If *index* is a :py:class:`rain.index.BuildIndex`, file digests are
+    remembered there by device and inode and reused while the size and
+    mtime still match, so that files shared with earlier trees by hard
+    links aren't read again.
+    """
+    remembered = {}
+    fresh = []
+    total = hashlib.blake2b(digest_size=20)
+
+    def digest_of(filename, st):
+        if st.st_dev not in remembered:
+            remembered[st.st_dev] = index.digests(st.st_dev) if index else {}
+
+        known = remembered[st.st_dev].get(st.st_ino)
+        if known and known[:2] == (st.st_size, st.st_mtime_ns):
+            digest = known[2]
+        else:
+            digest = file_digest(filename)
+
+        fresh.append((st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest))
+        return digest
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        if dirpath == path:
+            dirnames[:] = [name for name in dirnames
+                           if not any(fnmatch.fnmatch(name, pattern) for pattern in ignore)]
+            filenames = [name for name in filenames
+                         if not any(fnmatch.fnmatch(name, pattern) for pattern in ignore)]
+
+        dirnames.sort()
+        for name in sorted(filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]):
+            filename = os.path.join(dirpath, name)
+            relname = os.path.relpath(filename, path)
+            st = os.lstat(filename)
+
+            if stat.S_ISLNK(st.st_mode):
+                entry = 'l {} {}'.format(relname, os.readlink(filename))
+            elif stat.S_ISREG(st.st_mode):
+                entry = 'f {} {:o} {}'.format(relname, st.st_mode & 0o111, digest_of(filename, st))
+            else:
+                continue
+
+            total.update(entry.encode('utf-8', 'surrogateescape') + b'\0')
+
+    for filename in extra:
+        total.update('x {}'.format(file_digest(filename)).encode('utf-8') + b'\0')
+
+    if index:
+        now = time.time()
+        index.remember_digests(fresh, now, forget_before=now - digest_lifetime)
+
+    return total.hexdigest()
+
+def variant_fingerprint(fingerprint, settings):
+    """the *fingerprint* of a populated tree built with the environment *settings*"""
+    total = hashlib.blake2b(digest_size=20)
+    total.update('{}\0'.format(fingerprint).encode('utf-8'))
+    for name, value in sorted(settings.items()):
+        total.update('e {}={}'.format(name, value).encode('utf-8') + b'\0')
+
+    return total.hexdigest()
+
+
+class SharedCache:
+    """
+    A cache directory shared by every build in a work area, such as
+    for ccache and downloaded packages, held under *budget* bytes by
+    removing the least recently used files.
+
+    :py:attr:`environment` is exported to rain.mk, and a background
+    thread started by :py:meth:`start` evicts whenever
+    :py:meth:`poke` is called, and every *interval* seconds.  Eviction
+    stops at *low_water* of the budget so it needn't run after every
+    build.
+
+    Hits and misses are ccache's own, from the stats log each build
+    has it write, as named by :py:meth:`build_environment`, so they
+    neither depend on atime nor need a walk of the cache.
+    """
+
+    low_water = 0.9
+
+    def __init__(self, name, budget, logger, interval=600):
+        self.name = os.path.abspath(name)
+        self.budget = budget
+        self.logger = logger
+        self.interval = interval
+        self.event = threading.Event()
+        self.stopping = False
+        self.thread = None
+
+        for subdir in ['ccache', 'downloads', 'pip']:
+            path = os.path.join(self.name, subdir)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    @property
+    def environment(self):
+        return {
+            'RAIN_CACHE': self.name,
+            'RAIN_DOWNLOADS': os.path.join(self.name, 'downloads'),
+            'CCACHE_DIR': os.path.join(self.name, 'ccache'),
+            'PIP_CACHE_DIR': os.path.join(self.name, 'pip'),
+        }
+
+    def scan(self):
+        """:return: list of (last use, size, path) for every file"""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.name):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                entries.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+
+        return entries
+
+    def build_environment(self, dir):
+        """:py:attr:`environment` for the build in *dir*, with ccache logging its statistics there"""
+        return dict(self.environment, CCACHE_STATSLOG=os.path.abspath(os.path.join(dir, statslog)))
+
+    @staticmethod
+    def usage(dir):
+        """
+        :return: (hits, misses) from the ccache stats log of the build in
+            *dir*, or (None, None) if ccache wrote none.
+        """
+        hits = misses = 0
+        try:
+            with open(os.path.join(dir, statslog)) as f:
+                for line in f:
+                    line = line.strip()
+                    if line in hit_statistics:
+                        hits += 1
+                    elif line in miss_statistics:
+                        misses += 1
+        except FileNotFoundError:
+            return None, None
+
+        return hits, misses
+
+    def evict(self):
+        entries = self.scan()
+        total = sum(entry[1] for entry in entries)
+        if total <= self.budget:
+            return 0
+
+        target = self.budget * self.low_water
+        removed = 0
+        for lastuse, size, path in sorted(entries):
+            if total <= target:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total -= size
+            removed += 1
+
+        self.logger.info('%s - evicted %s files, %s bytes remain', self.name, removed, total)
+        return removed
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='cache eviction')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def poke(self):
+        self.event.set()
+
+    def stop(self):
+        if self.thread:
+            self.stopping = True
+            self.event.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            self.event.wait(self.interval)
+            self.event.clear()
+            if self.stopping:
+                return
+
+            try:
+                self.evict()
+            except OSError as e:
+                self.logger.error('%s - eviction failed: %s', self.name, e)
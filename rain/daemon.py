@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+A resident rain which owns the work area and answers queries over a
+unix domain socket, and the client side of that socket.
+
+Requests and responses are one line of json each.  Run as ``python -m
+rain.daemon ls`` for a client which imports nothing but the standard
+library and :py:mod:`rain.options`, falling back to
+:py:func:`rain.main.main` when no daemon is listening.  A request
+carries the client's :py:func:`settings`, and the daemon refuses it,
+rather than answer by its own, when they differ.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+import rain.options
+
+socket_name = '.rain.sock'
+
+# what the daemon answers, everything else is done directly
+actions = ['ls', 'status', 'keep', 'trigger']
+
+# the options a keep must share with the daemon, which keeps by its own
+retention = ['keep_days', 'keep_size', 'keep_good', 'archive_after']
+
+
+def settings(options):
+    """the parts of *options* a daemon must share to answer for them"""
+    result = dict((name, getattr(options, name)) for name in retention)
+    result['root'] = [os.path.abspath(root) for root in options.root or ['.']]
+    return result
+
+
+def disagreement(action, ours, theirs):
+    """the options among *theirs* a daemon with *ours* can't honour for *action*"""
+    names = ['root'] + (retention if action == 'keep' else [])
+    return ['--' + name.replace('_', '-') for name in names if ours[name] != theirs[name]]
+
+def request(action, path=socket_name, **args):
+    """
+    Ask the daemon listening on *path* to do *action*.
+
+    :return: its response, a dict of *output* and *status*, or None if
+        no daemon is listening.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+
+        client.sendall(json.dumps(dict(args, action=action)).encode('utf-8') + b'\n')
+        with client.makefile('rb') as f:
+            line = f.readline()
+    finally:
+        client.close()
+
+    return json.loads(line.decode('utf-8')) if line else None
+
+
+class DaemonRunning(Exception):
+    pass
+
+
+class Server:
+    """
+    Listens on *path* and answers each request by calling
+    *handle(action, **args)*, which returns the output, from a thread
+    per connection, unless the request's settings disagree with
+    *settings*.  'trigger' is answered here by releasing
+    :py:meth:`wait`, which the daemon's build loop uses as a gate.
+    """
+
+    def __init__(self, handle, logger, path=socket_name, settings=None):
+        self.handle = handle
+        self.settings = settings
+        self.logger = logger
+        self.path = path
+        self.triggered = threading.Event()
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            if request('ping', self.path) is not None:
+                raise DaemonRunning(self.path)
+            self.logger.info('removing stale socket %s', self.path)
+            os.remove(self.path)
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    response = server.respond(json.loads(line.decode('utf-8')))
+                    self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='daemon')
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info('listening on %s', self.path)
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = self.thread = None
+            os.remove(self.path)
+
+    def respond(self, args):
+        action = args.pop('action', None)
+        theirs = args.pop('settings', None)
+        if self.settings is not None and theirs is not None:
+            differ = disagreement(action, self.settings, theirs)
+            if differ:
+                return {'output': 'the daemon runs with other {}, stop it to {} with these'.format(
+                    ', '.join(differ), action), 'status': 1}
+
+        try:
+            if action == 'ping':
+                output = ''
+            elif action == 'trigger':
+                self.trigger()
+                output = ''
+            else:
+                output = self.handle(action, **args)
+        except Exception as e:
+            self.logger.error('%s failed: %s', action, e)
+            return {'output': str(e), 'status': 1}
+
+        return {'output': output, 'status': 0}
+
+    def trigger(self):
+        self.triggered.set()
+
+    def wait(self):
+        self.triggered.wait()
+        self.triggered.clear()
+
+
+def main(args=None):
+    """answer from the daemon if there is one, otherwise run rain directly"""
+    args = sys.argv[1:] if args is None else args
+    options = rain.options.parse(args)
+
+    if options.action in actions and os.path.exists(socket_name):
+        response = request(options.action, count=options.count, settings=settings(options))
+        if response is not None:
+            if response['output']:
+                print(response['output'])
+            return response['status']
+
+    import rain.main as direct
+    sys.argv[1:] = args
+    return direct.main()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+Persistent index of the builds in a work area.
+
+The per directory *.rain* files remain the authority on a build's
+state.  The index is a cache of them, along with the things a .rain
+file can't say, like when a build ran, how it exited and how big it
+is, kept in sqlite so that listing and retention needn't glob and read
+every directory.  Archived builds have no directory, only the archive
+named in their row, and their size is the archive's.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import os
+import sqlite3
+import threading
+
+class BuildIndex:
+    """
+    An sqlite database of builds, one row per working directory.
+
+    A single connection is shared by all threads, serialized by a lock.
+    Other processes sharing the file are serialized by sqlite itself.
+    """
+
+    filename = None
+    default_filename = '.rain.db'
+
+    columns = ['name', 'state', 'started', 'ended', 'exitcode', 'size', 'fingerprint', 'stamp', 'script',
+               'cache_hits', 'cache_misses', 'archive', 'revision', 'bisect', 'variant']
+
+    types = {
+        'name': 'text primary key',
+        'state': 'text',
+        'started': 'real',
+        'ended': 'real',
+        'exitcode': 'integer',
+        'size': 'integer',
+        'fingerprint': 'text',
+        'stamp': 'text',
+        'script': 'text',
+        'cache_hits': 'integer',
+        'cache_misses': 'integer',
+        'archive': 'text',
+        'revision': 'text',
+        'bisect': 'text',
+        'variant': 'text',
+    }
+
+    def __init__(self, filename=default_filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.created = not self.connection.execute(
+                "select name from sqlite_master where type = 'table' and name = 'builds'").fetchone()
+
+            self.connection.execute('create table if not exists builds (name text primary key)')
+
+            # add any columns which are newer than the database
+            have = [row[1] for row in self.connection.execute('pragma table_info(builds)')]
+            for column in self.columns:
+                if column not in have:
+                    self.connection.execute('alter table builds add column {} {}'.format(column, self.types[column]))
+
+            # builds are ordered by the time stamp part of their name, which
+            # differs from the name when builds live under several roots
+            for (name,) in self.connection.execute('select name from builds where stamp is null').fetchall():
+                self.connection.execute('update builds set stamp = ? where name = ?', (os.path.basename(name), name))
+
+            self.connection.execute('create index if not exists builds_state on builds (state, stamp)')
+            self.connection.execute('create index if not exists builds_stamp on builds (stamp)')
+            self.connection.execute('create index if not exists builds_fingerprint on builds (fingerprint)')
+
+            self.connection.execute('create table if not exists stages ('
+                                    'name text,'
+                                    ' stage text,'
+                                    ' key text,'
+                                    ' state text,'
+                                    ' exitcode integer,'
+                                    ' started real,'
+                                    ' ended real,'
+                                    ' primary key (name, stage))')
+            self.connection.execute('create index if not exists stages_key on stages (key, state)')
+
+            self.connection.execute('create table if not exists digests ('
+                                    'device integer,'
+                                    ' inode integer,'
+                                    ' size integer,'
+                                    ' mtime integer,'
+                                    ' digest text,'
+                                    ' used real,'
+                                    ' primary key (device, inode))')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def record(self, name, **fields):
+        """create or update the row for *name* with *fields*"""
+        for field in fields:
+            if field not in self.columns:
+                raise KeyError(field)
+
+        with self.lock, self.connection:
+            self.connection.execute('insert or ignore into builds (name, stamp) values (?, ?)',
+                                    (name, os.path.basename(name)))
+            if fields:
+                self.connection.execute('update builds set {} where name = ?'.format(
+                    ', '.join('{} = ?'.format(field) for field in fields)),
+                                        list(fields.values()) + [name])
+
+    def forget(self, name):
+        with self.lock, self.connection:
+            self.connection.execute('delete from builds where name = ?', (name,))
+            self.connection.execute('delete from stages where name = ?', (name,))
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute('delete from builds')
+            self.connection.execute('delete from stages')
+
+    stage_columns = ['stage', 'key', 'state', 'exitcode', 'started', 'ended']
+
+    def record_stage(self, name, stage, **fields):
+        """create or update the row for *stage* of the build *name* with *fields*"""
+        for field in fields:
+            if field not in self.stage_columns:
+                raise KeyError(field)
+
+        with self.lock, self.connection:
+            self.connection.execute('insert or ignore into stages (name, stage) values (?, ?)', (name, stage))
+            if fields:
+                self.connection.execute('update stages set {} where name = ? and stage = ?'.format(
+                    ', '.join('{} = ?'.format(field) for field in fields)),
+                                        list(fields.values()) + [name, stage])
+
+    def stages(self, name):
+        """the stages of the build *name* as dicts"""
+        with self.lock:
+            return [dict(zip(self.stage_columns, row)) for row in self.connection.execute(
+                'select {} from stages where name = ? order by started, stage'.format(', '.join(self.stage_columns)),
+                (name,))]
+
+    def matching_stage(self, key, exclude=None):
+        """the newest unarchived build which finished a stage with inputs *key*, or None"""
+        with self.lock:
+            row = self.connection.execute('select builds.name from stages join builds on stages.name = builds.name'
+                                          " where stages.key = ? and stages.state in ('done', 'cached')"
+                                          ' and builds.name is not ? and builds.archive is null'
+                                          ' order by builds.stamp desc, builds.name desc limit 1',
+                                          (key, exclude)).fetchone()
+
+        return row[0] if row else None
+
+    def shard_durations(self, stage, exclude=None):
+        """the durations of the shards of *stage* in the newest build where it succeeded, or []"""
+        with self.lock:
+            row = self.connection.execute('select builds.name from stages join builds on stages.name = builds.name'
+                                          ' where stages.stage = ? and stages.state = ? and builds.name is not ?'
+                                          ' order by builds.stamp desc, builds.name desc limit 1',
+                                          (stage, 'done', exclude)).fetchone()
+            if not row:
+                return []
+
+            prefix = stage + '/'
+            return [ended - started for shard, started, ended in self.connection.execute(
+                'select stage, started, ended from stages where name = ?', (row[0],))
+                    if shard.startswith(prefix) and started is not None and ended is not None]
+
+    def names(self):
+        """all recorded builds, oldest first"""
+        with self.lock:
+            return [row[0] for row in self.connection.execute('select name from builds order by stamp, name')]
+
+    def rows(self):
+        """all recorded builds as dicts, oldest first"""
+        with self.lock:
+            return [dict(zip(self.columns, row)) for row in self.connection.execute(
+                'select {} from builds order by stamp, name'.format(', '.join(self.columns)))]
+
+    def get(self, name):
+        with self.lock:
+            row = self.connection.execute('select {} from builds where name = ?'.format(', '.join(self.columns)),
+                                          (name,)).fetchone()
+
+        return dict(zip(self.columns, row)) if row else None
+
+    def state(self, name):
+        row = self.get(name)
+        return row['state'] if row else None
+
+    def last(self, state, exclude=()):
+        """
+        the newest unarchived build in *state*, other than those in
+        *exclude* and those bisecting, or None
+        """
+        exclude = list(exclude)
+        with self.lock:
+            row = self.connection.execute('select name from builds where state = ? and archive is null'
+                                          ' and revision is null and name not in ({})'
+                                          ' order by stamp desc, name desc limit 1'.format(', '.join('?' * len(exclude))),
+                                          [state] + exclude).fetchone()
+
+        return row[0] if row else None
+
+    def matching(self, fingerprint, states=('built', 'cached'), exclude=None):
+        """
+        the newest unarchived build, not bisecting, in one of *states*
+        with *fingerprint*, or None
+        """
+        with self.lock:
+            row = self.connection.execute('select name from builds where fingerprint = ? and name is not ?'
+                                          ' and archive is null and revision is null'
+                                          ' and state in ({}) order by stamp desc, name desc limit 1'.format(
+                                              ', '.join('?' * len(states))),
+                                          [fingerprint, exclude] + list(states)).fetchone()
+
+        return row[0] if row else None
+
+    def estimate(self, script, count=5):
+        """
+        the largest size of the last *count* finished builds by the
+        build script with digest *script*, or None if there were none
+        """
+        with self.lock:
+            row = self.connection.execute('select max(size) from (select size from builds'
+                                          ' where script = ? and size is not null and archive is null'
+                                          ' order by stamp desc limit ?)', (script, count)).fetchone()
+
+        return row[0]
+
+    def digests(self, device):
+        """remembered file digests on *device*, as {inode: (size, mtime, digest)}"""
+        with self.lock:
+            return dict((inode, (size, mtime, digest)) for inode, size, mtime, digest in self.connection.execute(
+                'select inode, size, mtime, digest from digests where device = ?', (device,)))
+
+    def remember_digests(self, rows, used, forget_before=None):
+        """
+        Store *rows* of (device, inode, size, mtime, digest) as used at
+        *used*, and drop digests last used before *forget_before*.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany('insert or replace into digests (device, inode, size, mtime, digest, used)'
+                                        ' values (?, ?, ?, ?, ?, ?)', [tuple(row) + (used,) for row in rows])
+            if forget_before is not None:
+                self.connection.execute('delete from digests where used < ?', (forget_before,))
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+Full text index of build logs, so that finding which builds logged
+an error needn't read every log in the work area.
+
+Lines are kept in an sqlite FTS5 table with the trigram tokenizer,
+which finds any substring of three or more characters.  Shorter
+patterns fall back to scanning the table, which is still quicker than
+reading the logs.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import contextlib
+import glob
+import gzip
+import io
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+@contextlib.contextmanager
+def open_log(filename):
+    """yield *filename* decompressed according to its suffix, as text lines"""
+    if filename.endswith('.gz'):
+        raw = gzip.open(filename, 'rb')
+    elif filename.endswith('.zst') and zstandard:
+        raw = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True,
+                                                         closefd=True)
+    elif filename.endswith('.zst') and shutil.which('zstd'):
+        proc = subprocess.Popen(['zstd', '-q', '-d', '-c', filename], stdout=subprocess.PIPE)
+        try:
+            with io.TextIOWrapper(proc.stdout, encoding='utf-8', errors='replace') as text:
+                yield text
+        finally:
+            proc.wait()
+        return
+    elif filename.endswith('.zst'):
+        raise IOError('{} needs zstandard or the zstd command'.format(filename))
+    else:
+        raw = open(filename, 'rb')
+
+    with io.TextIOWrapper(raw, encoding='utf-8', errors='replace') as text:
+        yield text
+
+def log_files(dir):
+    return sorted(filename for filename in glob.glob(os.path.join(dir, 'Log-*'))
+                  if not filename.endswith('.tail'))
+
+
+class LogIndex:
+    """
+    An sqlite database of log lines, kept separate from the build
+    index because it is much bigger.
+
+    :py:meth:`update` indexes the logs of finished builds which have
+    ended since they were last indexed and drops builds which are
+    gone.  Archived builds keep what was indexed before they were
+    archived.  With :py:meth:`start`, a background thread updates
+    whenever :py:meth:`poke` is called, and once more on
+    :py:meth:`stop`.
+    """
+
+    batch = 10000
+
+    def __init__(self, filename='.rain-logs.db'):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.updating = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.event = threading.Event()
+        self.thread = None
+        self.stopping = False
+        self.rows = None
+
+        with self.lock, self.connection:
+            self.connection.execute('create table if not exists builds (name text primary key, stamp text,'
+                                    ' ended real)')
+            self.connection.execute("create virtual table if not exists lines using fts5("
+                                    "name unindexed, stamp unindexed, log unindexed, lineno unindexed, text,"
+                                    " tokenize='trigram case_sensitive 1')")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def indexed(self):
+        """{name: ended} of the builds indexed"""
+        with self.lock:
+            return dict(self.connection.execute('select name, ended from builds'))
+
+    def add(self, name, ended):
+        """(re)index the logs of the build *name*"""
+        with self.lock, self.connection:
+            self.connection.execute('delete from lines where name = ?', (name,))
+
+        stamp = os.path.basename(name)
+        for filename in log_files(name):
+            try:
+                with open_log(filename) as lines:
+                    chunk = []
+                    for lineno, line in enumerate(lines, 1):
+                        chunk.append((name, stamp, filename, lineno, line.rstrip('\n')))
+                        if len(chunk) >= self.batch:
+                            self.insert(chunk)
+                            chunk = []
+                    self.insert(chunk)
+            except (IOError, EOFError) as e:
+                logger.warning('%s - not indexed: %s', filename, e)
+
+        with self.lock, self.connection:
+            self.connection.execute('insert or replace into builds (name, stamp, ended) values (?, ?, ?)',
+                                    (name, stamp, ended))
+
+    def insert(self, chunk):
+        with self.lock, self.connection:
+            self.connection.executemany('insert into lines (name, stamp, log, lineno, text) values (?, ?, ?, ?, ?)',
+                                        chunk)
+
+    def drop(self, name):
+        with self.lock, self.connection:
+            self.connection.execute('delete from lines where name = ?', (name,))
+            self.connection.execute('delete from builds where name = ?', (name,))
+
+    def update(self, rows):
+        """
+        Bring the index up to date with *rows* from
+        :py:meth:`rain.index.BuildIndex.rows`.
+
+        :return: how many builds were indexed.
+        """
+        with self.updating:
+            indexed = self.indexed()
+            names = set(row['name'] for row in rows)
+            for name in indexed:
+                if name not in names:
+                    self.drop(name)
+
+            count = 0
+            for row in rows:
+                if row['ended'] is None or row['archive'] or indexed.get(row['name']) == row['ended']:
+                    continue
+                if not os.path.isdir(row['name']):
+                    continue
+
+                self.add(row['name'], row['ended'])
+                count += 1
+
+        return count
+
+    def search(self, pattern):
+        """yield (build, log, line number, line) for lines containing *pattern*, oldest build first"""
+        if len(pattern) >= 3:
+            query = ('select name, log, lineno, text from lines where lines match ?'
+                     ' order by stamp, name, log, lineno')
+            args = ('"{}"'.format(pattern.replace('"', '""')),)
+        else:
+            query = ('select name, log, lineno, text from lines where instr(text, ?) > 0'
+                     ' order by stamp, name, log, lineno')
+            args = (pattern,)
+
+        with self.lock:
+            rows = self.connection.execute(query, args).fetchall()
+
+        for name, log, lineno, text in rows:
+            if pattern in text:
+                yield name, log, lineno, text
+
+    def first_seen(self, pattern):
+        """the oldest build whose logs contain *pattern*, or None"""
+        for name, log, lineno, text in self.search(pattern):
+            return name
+
+        return None
+
+    def start(self, rows):
+        """update in a background thread, from the callable *rows*, whenever poked"""
+        self.rows = rows
+        self.thread = threading.Thread(target=self.run, name='log index')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def poke(self):
+        self.event.set()
+
+    def stop(self):
+        if self.thread:
+            self.stopping = True
+            self.event.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+
+            try:
+                self.update(self.rows())
+            except (sqlite3.Error, OSError) as e:
+                logger.error('log indexing failed: %s', e)
+
+            if self.stopping:
+                return
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+Build logs which subprocess output is pumped through, rather than
+handed to the subprocess as a plain file, so they can be compressed on
+the fly, capped in size and have their tail kept in memory for triage.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import collections
+import gzip
+import logging
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+suffixes = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+class LogPipe:
+    """
+    A build log.  Used as a context manager, each entry appends a new
+    gzip member or zstd frame to *filename*, plus the suffix for
+    *compress*, so that populate and build can be written in separate
+    stages and the result still decompresses as one stream.
+
+    Once *cap* bytes of output have been written, if *cap* is set,
+    further output is dropped from the file, but the last *tail* bytes
+    are always kept in memory for :py:meth:`dump_tail`.
+    """
+
+    def __init__(self, filename, compress=None, cap=None, tail=1024 * 1024):
+        if compress == 'zstd' and not zstandard:
+            logger.warning('zstandard is not installed, compressing %s with gzip', filename)
+            compress = 'gzip'
+
+        if compress not in suffixes:
+            raise ValueError(compress)
+
+        self.compress = compress
+        self.basename = filename
+        self.filename = filename + suffixes[compress]
+        self.cap = cap
+        self.tailsize = tail
+        self.tail = collections.deque()
+        self.tailbytes = 0
+        self.written = 0
+        self.truncated = False
+        self.lock = threading.Lock()
+        self.raw = None
+        self.stream = None
+
+    def __enter__(self):
+        self.raw = open(self.filename, 'ab')
+        if self.compress == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='ab')
+        elif self.compress == 'zstd':
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.raw, closefd=False)
+        else:
+            self.stream = self.raw
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.stream is not self.raw:
+                self.stream.close()
+            self.raw.close()
+            self.stream = self.raw = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        with self.lock:
+            if self.tailsize:
+                self.tail.append(data)
+                self.tailbytes += len(data)
+                while self.tailbytes - len(self.tail[0]) >= self.tailsize:
+                    self.tailbytes -= len(self.tail.popleft())
+
+            if self.cap is not None:
+                room = self.cap - self.written
+                if room <= 0:
+                    if not self.truncated:
+                        self.truncated = True
+                        self.stream.write('\n[rain: log truncated at {} bytes]\n'.format(self.cap).encode('utf-8'))
+                    return
+
+                data = data[:room]
+
+            self.stream.write(data)
+            self.written += len(data)
+
+    def tail_bytes(self):
+        with self.lock:
+            data = b''.join(self.tail)
+
+        return data[-self.tailsize:] if self.tailsize else b''
+
+    def dump_tail(self):
+        """
+        Write the remembered tail, uncompressed, next to the log.
+
+        :return: the name of the file written, or None.
+        """
+        if not self.tailsize:
+            return None
+
+        filename = self.basename + '.tail'
+        with open(filename, 'wb') as tailfile:
+            tailfile.write(self.tail_bytes())
+
+        return filename
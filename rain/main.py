@@ -10,22 +10,51 @@ Shell callable driver for :py:mod:`rain`.
 """
 
 import argparse
+import collections
+import concurrent.futures
 import contextlib
 import datetime
 import fnmatch
 import glob
+import itertools
 import logging
 import os
+import queue
 import re
+import resource
 import shlex
+import signal
 import shutil
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
 
 import rain
+import rain.archive
+import rain.cache
+import rain.daemon
+import rain.logindex
+import rain.logpipe
+import rain.metrics
+import rain.options
+import rain.stages
+import rain.supervise
+import rain.trigger
+from rain.index import BuildIndex
 
 __docformat__ = "restructuredtext en"
 
-removal_cmds = ['remove', 'rm', 'delete', 'del']
+good_states = ['built', 'cached']
+
+# actions which only read the work area
+queries = ['ls', 'status', 'grep', 'first-seen']
+
+# actions which run rain.mk
+builders = ['build', 'resume', 'daemon', 'trigger', 'bisect']
+
+spare_prefix = '.rain-spare'
 
 @contextlib.contextmanager
 def pushdir(newdir):
@@ -53,29 +82,610 @@ def pushdir(newdir):
 def isodate():
     return datetime.datetime.now().isoformat()
 
+def clone_tree(source, destination, ignore=(), methods=('reflink', 'hardlink', 'copy')):
+    """
+    Populate the existing directory *destination* with the contents of
+    *source*, skipping top level names which match any of the
+    :py:mod:`fnmatch` patterns in *ignore*.  Tries each of *methods*
+    in turn, by default reflinks first, then hard links, then a plain
+    copy.
+
+    :return: the method which worked, 'reflink', 'hardlink' or 'copy',
+        or None, leaving *destination* as it was, if none did.
+    """
+    names = [name for name in os.listdir(source)
+             if not any(fnmatch.fnmatch(name, pattern) for pattern in ignore)]
+
+    def scrub():
+        for name in names:
+            path = os.path.join(destination, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+    if names and 'reflink' in methods:
+        with open(os.devnull, 'w') as devnull:
+            if not subprocess.call(['cp', '-a', '--reflink=always']
+                                   + [os.path.join(source, name) for name in names]
+                                   + [destination],
+                                   stdout=devnull, stderr=devnull):
+                return 'reflink'
+
+    for method, copy_function in [('hardlink', os.link), ('copy', shutil.copy2)]:
+        if method not in methods:
+            continue
+
+        scrub()
+        try:
+            for name in names:
+                src = os.path.join(source, name)
+                dst = os.path.join(destination, name)
+                if os.path.islink(src):
+                    os.symlink(os.readlink(src), dst)
+                elif os.path.isdir(src):
+                    shutil.copytree(src, dst, symlinks=True, copy_function=copy_function)
+                else:
+                    copy_function(src, dst)
+        except (OSError, shutil.Error):
+            if copy_function is shutil.copy2:
+                raise
+        else:
+            return method
+
+    scrub()
+    return None
+
+def link_missing(source, destination, ignore=()):
+    """
+    Hard link, or failing that copy, files from *source* which are
+    missing from *destination*.  Top level names matching *ignore* are
+    skipped.
+
+    :return: the number of files linked or copied.
+    """
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(source):
+        if dirpath == source:
+            dirnames[:] = [name for name in dirnames
+                           if not any(fnmatch.fnmatch(name, pattern) for pattern in ignore)]
+            filenames = [name for name in filenames
+                         if not any(fnmatch.fnmatch(name, pattern) for pattern in ignore)]
+
+        target = os.path.join(destination, os.path.relpath(dirpath, source))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(target, name)
+            if os.path.lexists(dst):
+                continue
+
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+            else:
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+            count += 1
+
+    return count
+
+def tree_size(path):
+    """bytes used by files under *path*, counting hard links once"""
+    seen = set()
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                size += st.st_size
+
+    return size
+
+class Reaper:
+    """
+    Removes directory trees in the background.  :py:meth:`discard`
+    renames a tree into a *trash* directory beside it, which is atomic
+    and quick, and a thread removes it from there at low I/O priority,
+    pausing for *throttle* seconds after every :py:attr:`batch`
+    entries.  Anything still in the trash under any of *roots* from an
+    earlier run is reaped when the thread starts.
+    """
+
+    batch = rain.options.reap_batch
+
+    def __init__(self, logger, trash='.rain-trash', throttle=0, ionice=3, roots=('.',)):
+        self.logger = logger
+        self.trash = trash
+        self.roots = roots
+        self.throttle = throttle
+        self.ionice = ionice
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        for root in self.roots:
+            trash = os.path.join(root, self.trash)
+            if not os.path.isdir(trash):
+                os.mkdir(trash)
+
+            for name in sorted(os.listdir(trash)):
+                self.queue.put(os.path.join(trash, name))
+
+        self.thread = threading.Thread(target=self.reap, name='reaper')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """wait for the trash to empty, then stop the thread"""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def discard(self, path):
+        trash = os.path.join(os.path.dirname(path), self.trash)
+        if not os.path.isdir(trash):
+            os.mkdir(trash)
+
+        holder = tempfile.mkdtemp(dir=trash)
+        try:
+            os.rename(path, os.path.join(holder, os.path.basename(path)))
+        except OSError:
+            os.rmdir(holder)
+            self.logger.debug('%s - cannot move to trash, removing inline', path)
+            shutil.rmtree(path)
+            return
+
+        self.queue.put(holder)
+
+    def reap(self):
+        if self.ionice and hasattr(threading, 'get_native_id'):
+            # I/O priority is per thread on linux.
+            with open(os.devnull, 'w') as devnull:
+                try:
+                    subprocess.call(['ionice', '-c', str(self.ionice), '-p', str(threading.get_native_id())],
+                                    stdout=devnull, stderr=devnull)
+                except OSError:
+                    self.logger.debug('no ionice, reaping at normal priority')
+
+        while True:
+            path = self.queue.get()
+            if path is None:
+                break
+
+            self.logger.debug('%s reaping...', path)
+            try:
+                self.remove(path)
+            except OSError as e:
+                self.logger.error('%s reaping failed: %s', path, e)
+            self.logger.debug('%s reaped.', path)
+
+    def remove(self, path):
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for name in filenames:
+                os.remove(os.path.join(dirpath, name))
+            for name in dirnames:
+                subdir = os.path.join(dirpath, name)
+                if os.path.islink(subdir):
+                    os.remove(subdir)
+                else:
+                    os.rmdir(subdir)
+
+            count += len(filenames) + len(dirnames)
+            if self.throttle and count >= self.batch:
+                time.sleep(self.throttle)
+                count = 0
+
+        os.rmdir(path)
+
+
 class WorkArea:
-    def __init__(self, logger):
+    """
+    The builds rain manages.  Builds live in the current directory, or
+    with a *scheduler*, under whichever of its locations it picks.
+    *roots* are all the directories holding builds.
+
+    With a *memory* :py:class:`rain.MemoryRoot`, builds whose earlier
+    runs fit run in memory and are spilled to their place on disk,
+    either moved or as an archive according to *spill*, once done.
+
+    A *shared_cache* :py:class:`rain.cache.SharedCache` is exported to
+    every build.
+
+    Besides a count, :py:meth:`keep` removes builds which ended more
+    than *max_age* seconds ago and the oldest builds beyond a total of
+    *budget* bytes, except that with *keep_good* it never removes the
+    newest good build nor the first failure after it.  With
+    *archive_after*, it replaces all but that many of the builds it
+    keeps with archives of their status, logs and files matching
+    *archive_globs*.
+
+    rain.mk runs under *supervisor*, by default the process wide
+    :py:func:`rain.supervise.supervisor`, with *timeouts* in seconds by
+    target and *limits*, :py:mod:`resource` limits to values, set on it.
+
+    A *logindex* :py:class:`rain.logindex.LogIndex` is poked as each
+    build is released.
+
+    With *readonly*, as for queries, a missing index is neither created
+    nor filled in by walking every tree.
+
+    With *stages*, builds run the stages rain.mk declares, as for
+    :py:mod:`rain.stages`, and sharded stages run in enough shards for
+    each to take about *shard_target* seconds, going by their last run.
+    """
+
+    def __init__(self, logger, seed=False, reaper=None, index=None, cache=None, logconfig=None, prometheus=None,
+                 location=None, scheduler=None, roots=('.',), memory=None, spill='move', shared_cache=None,
+                 archive_after=None, archive_globs=(), max_age=None, budget=None, keep_good=False,
+                 supervisor=None, timeouts=None, limits=None, logindex=None, shard_target=None, stages=False,
+                 readonly=False):
         self.logger = logger
+        self.stages = stages
+        self.logindex = logindex
+        self.shard_target = shard_target
+        self.supervisor = supervisor
+        self.timeouts = timeouts or {}
+        self.limits = limits
+        self.max_age = max_age
+        self.budget = budget
+        self.keep_good = keep_good
+        self.archive_after = archive_after
+        self.archive_globs = archive_globs
+        self.shared_cache = shared_cache
+        self.memory = memory
+        self.spill = spill
+        self.location = location
+        self.scheduler = scheduler
+        self.roots = roots
+        self.prometheus = prometheus
+        self.seed = seed
+        self.reaper = reaper
+        self.cache = cache
+        self.logconfig = logconfig or {}
+        self.lock = threading.Lock()
+        self.keeping = threading.Lock()
+        self.reserved = collections.Counter()
+        self.building = set()
+
+        # a query where there is no index answers from the disk, leaving none behind
+        if index is None and readonly and not os.path.exists(BuildIndex.default_filename):
+            index = BuildIndex(':memory:')
+
+        self.index = BuildIndex() if index is None else index
+        if self.index.created:
+            self.reindex(sizes=not readonly)
+
+    def scan(self):
+        """find builds on disk, bypassing the index"""
+        dirs = []
+        for root in self.roots:
+            dirs.extend(os.path.dirname(d) for d in glob.glob(self.path(root, os.path.join('*', '.rain'))))
+
+        return sorted(dirs, key=lambda dir: (os.path.basename(dir), dir))
+
+    def scan_archives(self):
+        """find archived builds on disk, bypassing the index"""
+        archives = []
+        for root in self.roots:
+            for suffix in rain.archive.suffixes:
+                archives.extend(glob.glob(self.path(root, '*' + suffix)))
+
+        return sorted(archives)
+
+    @staticmethod
+    def path(root, name):
+        return name if root in ['.', ''] else os.path.join(root, name)
 
     @staticmethod
-    def raindirs():
-        return sorted([os.path.dirname(d) for d in glob.glob('*/.rain')])
+    def read_state(dir):
+        try:
+            with open(os.path.join(dir, '.rain')) as dotrain:
+                return dotrain.read().strip()
+        except IOError:
+            return None
+
+    def reindex(self, sizes=True):
+        """rebuild the index from the .rain files on disk, walking each tree for its size if *sizes*"""
+        self.logger.info('reindexing...')
+        self.index.clear()
+        for dir in self.scan():
+            self.index.record(dir,
+                              state=self.read_state(dir),
+                              ended=os.stat(os.path.join(dir, '.rain')).st_mtime,
+                              size=tree_size(dir) if sizes else None)
+
+        for filename in self.scan_archives():
+            dir = rain.archive.build_name(filename)
+            if self.index.get(dir):
+                continue # archiving was interrupted, the tree is still there
+
+            try:
+                state = rain.archive.read_member(filename, '.rain')
+            except IOError as e:
+                self.logger.warning('%s - cannot read its state: %s', dir, e)
+                state = None
+
+            self.index.record(dir,
+                              state=state.decode('utf-8').strip() if state else None,
+                              ended=os.stat(filename).st_mtime,
+                              size=os.path.getsize(filename),
+                              archive=filename)
+        self.logger.debug('reindexed.')
+
+    def raindirs(self):
+        return self.index.names()
+
+    def last_built(self):
+        """
+        the most recent directory whose build succeeded, or None.
+        Builds still in flight, which may yet be spilled from memory,
+        don't count.
+        """
+        return self.index.last('built', exclude=self.building)
+
+    @property
+    def retaining(self):
+        """whether :py:meth:`keep` has anything to do besides a count"""
+        return (self.max_age is not None or self.budget is not None or self.archive_after is not None)
+
+    def protected(self, rows):
+        """
+        With *keep_good*, the names among *rows* of the newest good
+        build and the first failure after it, leaving out builds of
+        other revisions made by bisect.
+        """
+        if not self.keep_good:
+            return set()
+
+        rows = [row for row in rows if row['revision'] is None]
+
+        good = [i for i, row in enumerate(rows) if row['state'] in good_states]
+        if not good:
+            return set()
+
+        names = set([rows[good[-1]]['name']])
+        for row in rows[good[-1] + 1:]:
+            if row['exitcode']:
+                names.add(row['name'])
+                break
+
+        return names
+
+    def doomed(self, rows, count, now=None):
+        """
+        The names among *rows*, oldest first, which should go: all but
+        the newest *count* if *count* isn't negative, those which ended
+        more than *max_age* seconds before *now*, then the oldest of the
+        rest until the recorded sizes fit in *budget* bytes.  Protected
+        builds stay regardless.
+        """
+        now = time.time() if now is None else now
+        protected = self.protected(rows)
+        candidates = [row for row in rows if row['name'] not in protected]
+        doomed = set()
+
+        if count >= 0:
+            doomed.update(row['name'] for row in candidates[:max(0, len(candidates) - count)])
+
+        if self.max_age is not None:
+            doomed.update(row['name'] for row in candidates
+                          if row['ended'] is not None and now - row['ended'] > self.max_age)
+
+        if self.budget is not None:
+            total = sum(row['size'] or 0 for row in rows if row['name'] not in doomed)
+            for row in candidates:
+                if total <= self.budget:
+                    break
+                if row['name'] not in doomed:
+                    doomed.add(row['name'])
+                    total -= row['size'] or 0
+
+        return [row['name'] for row in rows if row['name'] in doomed]
 
     def keep(self, count):
-        dirs = self.raindirs()
-        if count == 0:
-            for dir in dirs:
-                self.logger.info('%s removing...', dir)
-                shutil.rmtree(dir)
-                self.logger.debug('%s removed.', dir)
+        """
+        Remove the builds :py:meth:`doomed` picks, then archive all but
+        the newest *archive_after* of the rest.
+        """
+        with self.keeping:
+            with self.lock:
+                rows = [row for row in self.index.rows() if row['name'] not in self.reserved]
+
+            doomed = self.doomed(rows, count)
+            for dir in doomed:
+                self.remove(dir)
+
+            if self.archive_after is not None:
+                protected = self.protected(rows)
+                rows = [row for row in rows if row['name'] not in doomed]
+                for row in rows[:max(0, len(rows) - self.archive_after)]:
+                    if not row['archive'] and row['name'] not in protected:
+                        self.archive(row['name'])
+
+    def discard(self, dir):
+        if self.reaper:
+            self.reaper.discard(dir)
         else:
-            for dir in dirs[:-count]:
-                self.logger.info('%s removing...', dir)
-                shutil.rmtree(dir)
-                self.logger.debug('%s removed.', dir)
+            shutil.rmtree(dir)
+
+    def remove(self, dir):
+        self.logger.info('%s removing...', dir)
+        row = self.index.get(dir)
+        if row and row['archive']:
+            if os.path.lexists(row['archive']):
+                os.remove(row['archive'])
+            else:
+                self.logger.debug('%s - %s already gone', dir, row['archive'])
+        elif os.path.lexists(dir):
+            self.discard(dir)
+        else:
+            self.logger.debug('%s - already gone', dir)
+        self.index.forget(dir)
+        self.logger.debug('%s removed.', dir)
+
+    def archive(self, dir):
+        """replace the tree *dir* with an archive"""
+        self.logger.info('%s archiving...', dir)
+        filename = rain.archive.archive(dir, self.archive_globs)
+        self.index.record(dir, archive=filename, size=os.path.getsize(filename))
+        self.discard(dir)
+        self.logger.debug('%s archived to %s.', dir, filename)
+
+    def find(self, name):
+        """the build called *name*, or whose time stamp is *name*, or None"""
+        names = self.raindirs()
+        if name in names:
+            return name
+
+        matches = [dir for dir in names if os.path.basename(dir) == name]
+        return matches[0] if len(matches) == 1 else None
+
+    def extract(self, dir):
+        """
+        Restore the archived build *dir* as a tree.  Only what was
+        archived comes back, and a later :py:meth:`keep` may archive it
+        again.
+        """
+        row = self.index.get(dir)
+        if not row or not row['archive']:
+            raise ValueError('{} is not archived'.format(dir))
+
+        self.logger.info('%s extracting...', dir)
+        rain.archive.extract(row['archive'], dir)
+        self.index.record(dir, archive=None, size=tree_size(dir))
+        os.remove(row['archive'])
+        self.logger.debug('%s extracted.', dir)
+
+    def new_working_directory(self, buildscript, environment=None, seed=None, seed_methods=None, seed_from=None):
+        """
+        Reserve a fresh name and return a :py:class:`WorkingDirectory`
+        for it.  Builds which start within the resolution of
+        :py:func:`isodate` get a numeric suffix so that concurrent
+        builds never share a directory.
+
+        *environment* is exported to rain.mk and *seed*, if not None,
+        overrides whether to seed from the last good build, or from
+        *seed_from* if given, and *seed_methods* how, as for
+        :py:func:`clone_tree`.
+        """
+        location = self.scheduler.pick() if self.scheduler else self.location
+        root = location.name if location else '.'
+
+        with self.lock:
+            base = stamp = isodate()
+            name = self.path(root, stamp)
+            suffix = 0
+            while name in self.reserved or os.path.lexists(name):
+                suffix += 1
+                stamp = '{}-{}'.format(base, suffix)
+                name = self.path(root, stamp)
+
+            self.reserved[name] += 1
+            self.building.add(name)
+
+            if not (self.seed if seed is None else seed):
+                seed = None
+            else:
+                seed = seed_from or self.last_built()
+            if seed:
+                self.reserved[seed] += 1
+
+        script = rain.cache.file_digest(buildscript) if os.path.isfile(buildscript) else None
+
+        memory = None
+        if self.memory:
+            estimate = self.index.estimate(script) if script else None
+            memory = self.memory.claim(stamp, estimate)
+            if memory:
+                self.logger.debug('%s - expecting %s bytes, building in %s', name, estimate, memory)
+
+        return WorkingDirectory(self.logger, name, buildscript, seed=seed, reaper=self.reaper, index=self.index,
+                                cache=self.cache, logconfig=self.logconfig, prometheus=self.prometheus,
+                                location=location, script=script, memory=memory, spill=self.spill,
+                                shared_cache=self.shared_cache, supervisor=self.supervisor, timeouts=self.timeouts,
+                                limits=self.limits, environment=environment, seed_methods=seed_methods,
+                                shard_target=self.shard_target, stages=self.stages)
+
+    def resumable(self):
+        """
+        Directories left populated by a rain which stopped before
+        building them, going by their .rain in case the index lags.
+        Assumes no other rain is building in this area.
+        """
+        with self.lock:
+            building = set(self.building)
+
+        return [row['name'] for row in self.index.rows()
+                if row['exitcode'] is None and not row['archive'] and row['name'] not in building
+                and os.path.isdir(row['name']) and self.read_state(row['name']) == 'populated']
+
+    def resume_working_directory(self, dir, buildscript):
+        """reserve the populated *dir* and return a :py:class:`WorkingDirectory` to build it"""
+        with self.lock:
+            self.reserved[dir] += 1
+            self.building.add(dir)
 
-    def new_working_directory(self, buildscript):
-        return WorkingDirectory(self.logger, isodate(), buildscript)
+        row = self.index.get(dir)
+        script = rain.cache.file_digest(buildscript) if os.path.isfile(buildscript) else None
+        if row['script'] and script != row['script']:
+            self.logger.warning('%s - %s has changed since it was populated', dir, buildscript)
+
+        # a build which was in memory is still there unless the host rebooted
+        memory = os.path.realpath(dir) if os.path.islink(dir) else None
+
+        wd = WorkingDirectory(self.logger, dir, buildscript, reaper=self.reaper, index=self.index,
+                              cache=self.cache, logconfig=self.logconfig, prometheus=self.prometheus,
+                              script=row['script'], memory=memory, spill=self.spill,
+                              shared_cache=self.shared_cache, supervisor=self.supervisor, timeouts=self.timeouts,
+                              limits=self.limits, shard_target=self.shard_target, stages=self.stages)
+        wd.state = 'populated'
+        wd.started = row['started']
+        return wd
+
+    def cancel(self):
+        """kill every build running and refuse to start more"""
+        self.logger.warning('cancelling builds...')
+        (self.supervisor or rain.supervise.supervisor()).cancel()
+
+    def release(self, wd):
+        """spill *wd* to disk if need be, and forget it and its seed are in use"""
+        if wd.memory:
+            try:
+                wd.spill_to_disk()
+            finally:
+                if self.memory:
+                    self.memory.release(wd.memory)
+                wd.memory = None
+
+        if wd.workspace:
+            wd.location.release(wd.workspace)
+            wd.workspace = None
+
+        if self.scheduler and wd.location:
+            self.scheduler.release(wd.location)
+            wd.location = None
+
+        with self.lock:
+            self.building.discard(wd.name)
+            for name in [wd.name, wd.seed]:
+                if name:
+                    self.reserved[name] -= 1
+                    if self.reserved[name] <= 0:
+                        del self.reserved[name]
+
+        if self.logindex:
+            self.logindex.poke()
 
 class PopulationException(Exception):
     pass
@@ -84,22 +694,94 @@ class BuildException(Exception):
     pass
 
 class WorkingDirectory:
-    def __init__(self, logger, name, buildscript):
+    """
+    One build.  *cache* may be 'skip', to skip the build when an earlier
+    build had the same populated tree, or 'link', which also hard links
+    that earlier build's outputs in.  Caching needs an *index*.
+    *logconfig* holds keyword arguments for the build's
+    :py:class:`rain.logpipe.LogPipe`.  Phase timings are written to
+    *.rain.json* and, if *prometheus* names a file, there too.  If
+    *location* is a :py:class:`rain.Location`, the directory is one of
+    its pre-created work spaces renamed into place.  If *memory* names
+    a directory, typically on tmpfs, the build runs there behind a
+    symlink until :py:meth:`spill_to_disk`.  *script* is the digest of
+    the build script.
+
+    *environment* holds variables for rain.mk on top of our own, and
+    a *shared_cache*'s variables are added to them.
+    """
+
+    # seconds to wait for rain.mk stages unless timeouts says otherwise
+    stages_timeout = 60
+
+    # top level names which are rain's rather than the build's
+    bookkeeping = ['.rain', '.rain.new', '.rain.json', '.rain.stages', '.rain.stages.new', rain.cache.statslog,
+                   'Log-*']
+
+    def __init__(self, logger, name, buildscript, seed=None, reaper=None, index=None, cache=None, logconfig=None,
+                 prometheus=None, location=None, script=None, memory=None, spill='move', environment=None,
+                 shared_cache=None, supervisor=None, timeouts=None, limits=None, seed_methods=None,
+                 shard_target=None, stages=False):
         self.logger = logger
+        self.stages = stages
+        self.seed_options = {'methods': seed_methods} if seed_methods else {}
+        self.shard_target = shard_target
+        self.stage_lock = threading.Lock()
+        self.supervisor = supervisor
+        self.timeouts = timeouts or {}
+        self.limits = limits
         self.name = name
         self.buildscript = buildscript
+        self.seed = seed
+        self.reaper = reaper
+        self.index = index
+        self.cache = cache if index else None
+        self.logconfig = logconfig or {}
+        self.log = None
+        self.prometheus = prometheus
+        self.metrics = rain.metrics.Metrics()
+        self.state = None
+        self.location = location
+        self.workspace = None
+        self.script = script
+        self.memory = memory
+        self.spill = spill
+        self.shared_cache = shared_cache
+        self.environment = dict(environment or {})
+        if shared_cache:
+            self.environment.update(shared_cache.build_environment(name))
+        self.started = None
 
     def clear(self):
         if os.path.exists(self.name):
             if os.path.isdir(self.name):
                 self.logger.info('removing existing directory named \"%s\"', self.name)
-                shutil.rmtree(self.name)
+                if self.reaper:
+                    self.reaper.discard(self.name)
+                else:
+                    shutil.rmtree(self.name)
             else:
                 self.logger.info('removing existing file named \"%s\"', self.name)
                 os.remove(self.name)
 
-        self.logger.info('%s - mkdir', self.name)
-        os.mkdir(self.name)
+        if os.path.islink(self.name):
+            os.remove(self.name)
+
+        if self.memory:
+            self.logger.info('%s - in memory at %s', self.name, self.memory)
+            os.symlink(os.path.abspath(self.memory), self.name)
+        elif self.location:
+            self.logger.info('%s - allocating', self.name)
+            try:
+                self.workspace = self.location.next_workspace(name=self.name)
+            except rain.AllocationError:
+                self.logger.error('%s - no work space free in %s', self.name, self.location.name)
+                if self.index:
+                    self.index.forget(self.name)
+                raise
+        else:
+            self.logger.info('%s - mkdir', self.name)
+            os.mkdir(self.name)
 
     @contextlib.contextmanager
     def pushdir(self):
@@ -109,40 +791,822 @@ class WorkingDirectory:
 
         os.chdir(savedir)
 
+    def replace(self, name, text):
+        """atomically replace *name* in the directory, so a crash never leaves it partly written"""
+        filename = os.path.join(self.name, name)
+        with open(filename + '.new', 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + '.new', filename)
+
     def status(self, state):
-        with open('.rain', 'w') as dotrain:
-            dotrain.write('{}\n'.format(state))
+        """replace .rain and update the index"""
+        self.replace('.rain', '{}\n'.format(state))
+
+        self.state = state
+        if self.index:
+            if state == 'incomplete':
+                self.started = time.time()
+                self.index.record(self.name, state=state, started=self.started,
+                                  ended=None, exitcode=None, size=None, script=self.script)
+            else:
+                self.index.record(self.name, state=state)
+
+    def finished(self, exitcode):
+        """record how and when the build ended, its size and timings"""
+        ended = time.time()
+        extra = {}
+        if self.shared_cache:
+            extra['cache_hits'], extra['cache_misses'] = self.shared_cache.usage(self.name)
+            self.shared_cache.poke()
+
+        if self.index:
+            self.index.record(self.name, ended=ended, exitcode=exitcode, size=tree_size(self.name), **extra)
+
+        self.metrics.write_json(os.path.join(self.name, '.rain.json'), name=self.name, state=self.state,
+                                exitcode=exitcode, ended=ended, **extra)
+        if self.prometheus:
+            rain.metrics.write_prometheus(self.prometheus, self.metrics, self.state, ended)
+
+    def spill_to_disk(self):
+        """
+        Replace the symlink to a build in memory with the build itself,
+        or with its bookkeeping files and a *tree.tar.gz* of the rest.
+        """
+        if not os.path.islink(self.name):
+            return
+
+        self.logger.info('%s - spilling %s to disk', self.name, self.memory)
+        os.remove(self.name)
+
+        if self.spill == 'archive':
+            os.mkdir(self.name)
+            kept = [name for name in os.listdir(self.memory)
+                    if any(fnmatch.fnmatch(name, pattern) for pattern in self.bookkeeping)]
+            for name in kept:
+                shutil.move(os.path.join(self.memory, name), os.path.join(self.name, name))
+
+            with tarfile.open(os.path.join(self.name, 'tree.tar.gz'), 'w|gz') as tar:
+                tar.add(self.memory, arcname='.')
+            shutil.rmtree(self.memory)
+        else:
+            shutil.move(self.memory, self.name)
+
+        self.logger.debug('%s - spilled.', self.name)
 
     def populate(self, logfile):
-        retval = self.subcall(logfile, 'populate')
+        with self.metrics.phase('populate'):
+            retval = self.subcall(logfile, 'populate')
+
         if retval:
             self.logger.error('{} populate failed'.format(self.name))
+            self.dump_tail(logfile)
+            self.finished(retval)
             raise PopulationException
 
+        if self.cache:
+            extra = [self.buildscript] if os.path.isfile(self.buildscript) else []
+            with self.metrics.phase('fingerprint'):
+                fingerprint = rain.cache.fingerprint(self.name, self.index, ignore=self.bookkeeping, extra=extra)
+            self.logger.debug('%s - fingerprint %s', self.name, fingerprint)
+            self.index.record(self.name, fingerprint=fingerprint)
+
         self.status('populated')
         return not retval
 
+    def cached(self):
+        """
+        If an earlier build had the same fingerprint, mark this one
+        'cached', link in the earlier outputs if asked, and return the
+        earlier build's name.
+        """
+        if not self.cache:
+            return None
+
+        row = self.index.get(self.name)
+        earlier = self.index.matching(row['fingerprint'], exclude=self.name) if row and row['fingerprint'] else None
+        if not earlier:
+            return None
+
+        self.logger.info('%s - unchanged since %s, skipping build', self.name, earlier)
+        if self.cache == 'link' and os.path.isdir(earlier):
+            count = link_missing(earlier, self.name, ignore=self.bookkeeping)
+            self.logger.debug('%s - linked %s files from %s', self.name, count, earlier)
+
+        self.status('cached')
+        self.finished(0)
+        return earlier
+
     def build(self, logfile):
-        retval = self.subcall(logfile, 'build')
+        if self.cached():
+            return True
+
+        graph = self.declared_stages()
+        if graph:
+            return self.run_stages(logfile, graph)
+
+        with self.metrics.phase('build'):
+            retval = self.subcall(logfile, 'build')
 
         if retval:
             self.logger.error('{} build failed'.format(self.name))
+            self.dump_tail(logfile)
+            self.finished(retval)
             raise BuildException
 
         self.status('built')
+        self.finished(retval)
         return not retval
 
-    def subcall(self, logfile, target):
+    def declared_stages(self):
+        """
+        With *stages*, ask ``rain.mk stages`` under the supervisor for
+        the stage graph, as for :py:func:`rain.stages.parse`.
+
+        :return: the graph, or None for the single build stage, as when
+            rain.mk fails or prints something which doesn't parse.
+        """
+        if not self.stages:
+            return None
+
+        with tempfile.TemporaryFile() as output:
+            retval = self.subcall(output, 'stages', timeout=self.timeouts.get('stages') or self.stages_timeout)
+            output.seek(0)
+            text = output.read().decode('utf-8', 'replace')
+
+        if retval:
+            self.logger.warning('%s - rain.mk stages exited %s, building in one stage', self.name, retval)
+            return None
+
+        try:
+            graph = rain.stages.parse(text)
+            if graph:
+                rain.stages.order(graph)
+        except rain.stages.StageError as e:
+            self.logger.warning('%s - %s, building in one stage', self.name, e)
+            return None
+
+        return graph
+
+    def stage_status(self, states, stage, state, **fields):
+        """set *stage* to *state* in *states*, .rain.stages and the index"""
+        with self.stage_lock:
+            states[stage] = state
+            self.replace('.rain.stages', ''.join('{} {}\n'.format(name, value) for name, value in states.items()))
+            if self.index:
+                self.index.record_stage(self.name, stage, state=state, **fields)
+
+    def run_stages(self, logfile, graph):
+        """
+        Run the stages of *graph*, each as soon as those it depends on
+        have succeeded and each with its own log beside *logfile*.
+        Stages which depend on a failed stage are skipped.
+
+        With a cache, stages chosen by :py:meth:`cached_stages` are
+        marked 'cached' rather than run, linking in the earlier build's
+        files if asked.
+        """
+        ordered = rain.stages.order(graph)
+        states = collections.OrderedDict((stage, 'waiting') for stage in ordered)
+        keys = dict((stage, None) for stage in ordered)
+
+        row = self.index.get(self.name) if self.cache else None
+        if row and row['fingerprint']:
+            keys = rain.stages.keys(graph, row['fingerprint'])
+
+        for stage in ordered:
+            self.stage_status(states, stage, 'waiting', key=keys[stage], exitcode=None, started=None, ended=None)
+
+        if row and row['fingerprint']:
+            for stage, earlier in self.cached_stages(graph, ordered, keys):
+                self.logger.info('%s - %s unchanged since %s', self.name, stage, earlier)
+                if self.cache == 'link':
+                    link_missing(earlier, self.name, ignore=self.bookkeeping)
+                self.stage_status(states, stage, 'cached')
+
+        exitcodes = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ordered)) as pool:
+            running = {}
+            while True:
+                for stage in ordered:
+                    if states[stage] != 'waiting':
+                        continue
+
+                    deps = [states[dep] for dep in graph[stage]]
+                    if any(state in ['failed', 'skipped'] for state in deps):
+                        self.stage_status(states, stage, 'skipped')
+                    elif all(state in rain.stages.good_states for state in deps):
+                        self.stage_status(states, stage, 'running', started=time.time())
+                        running[pool.submit(self.run_stage, logfile, graph, stage, states)] = stage
+
+                if not running:
+                    break
+
+                done, pending = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    exitcodes[stage] = future.result()
+                    self.stage_status(states, stage, 'failed' if exitcodes[stage] else 'done',
+                                      exitcode=exitcodes[stage], ended=time.time())
+
+        failed = [stage for stage in ordered if states[stage] == 'failed']
+        if failed:
+            self.logger.error('%s %s failed', self.name, ', '.join(failed))
+            self.finished(exitcodes[failed[0]])
+            raise BuildException
+
+        self.status('built')
+        self.finished(0)
+        return True
+
+    def cached_stages(self, graph, ordered, keys):
+        """
+        Stages whose inputs, *keys*, match a stage an earlier build
+        finished, as when that build failed in a later stage, and whose
+        own dependencies are also cached.  Linking brings in the earlier
+        outputs, so needs the earlier build's directory, while skipping
+        leaves them out of this tree, so only does for stages which
+        nothing left to run depends on.
+
+        :return: list of (stage, earlier build) in *ordered* order.
+        """
+        matches = collections.OrderedDict()
+        for stage in ordered:
+            if not all(dep in matches for dep in graph[stage]):
+                continue
+
+            earlier = self.index.matching_stage(keys[stage], exclude=self.name)
+            if earlier and (self.cache != 'link' or os.path.isdir(earlier)):
+                matches[stage] = earlier
+
+        if self.cache != 'link':
+            for stage in reversed(ordered):
+                if stage in matches and any(stage in graph[other] and other not in matches for other in ordered):
+                    del matches[stage]
+
+        return list(matches.items())
+
+    def run_stage(self, logfile, graph, stage, states):
+        """
+        run *stage* with its own log, noting it in *logfile*, and kill it,
+        or each of its shards, after *timeouts[stage]* seconds or else
+        *timeouts['build']*
+        """
+        basename = logfile.basename if isinstance(logfile, rain.logpipe.LogPipe) else logfile.name
+        log = rain.logpipe.LogPipe('{}-{}'.format(basename, stage), **self.logconfig)
+        logfile.write('[rain: {} started, logging to {}]\n'.format(stage, os.path.basename(log.filename)))
+
+        timeout = self.timeouts.get(stage) or self.timeouts.get('build')
+        with log:
+            with self.metrics.phase(stage):
+                if stage in graph.shards:
+                    retval = self.run_shards(log, stage, graph.shards[stage], states, timeout)
+                else:
+                    retval = self.subcall(log, stage, timeout=timeout)
+
+        logfile.write('[rain: {} exited {}]\n'.format(stage, retval))
+        if retval and stage not in graph.shards:
+            self.dump_tail(log)
+        return retval
+
+    def run_shards(self, log, stage, most, states, timeout=None):
+        """
+        Run up to *most* shards of *stage* at once in this tree, then
+        append their logs to *log* in order.
+
+        :return: the exit status of the first shard which failed, or 0.
+        """
+        durations = self.index.shard_durations(stage, exclude=self.name) if self.index else []
+        count = rain.stages.shard_count(most, durations, self.shard_target)
+        self.logger.info('%s - %s in %s shards', self.name, stage, count)
+        log.write('[rain: {} in {} shards]\n'.format(stage, count))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=count) as pool:
+            futures = [pool.submit(self.run_shard, log.basename, stage, index, count, states, timeout)
+                       for index in range(count)]
+            results = [future.result() for future in futures]
+
+        for index, (filename, retval) in enumerate(results):
+            log.write('[rain: shard {}/{} exited {}]\n'.format(index, count, retval))
+            with rain.logindex.open_log(filename) as lines:
+                for line in lines:
+                    log.write(line)
+            os.remove(filename)
+
+        return next((retval for filename, retval in results if retval), 0)
+
+    def run_shard(self, basename, stage, index, count, states, timeout=None):
+        """:return: the log and exit status of shard *index* of *count* of *stage*"""
+        shard = '{}/{}'.format(stage, index)
+        self.stage_status(states, shard, 'running', started=time.time())
+
+        log = rain.logpipe.LogPipe('{}.{}'.format(basename, index), **self.logconfig)
+        with log:
+            retval = self.subcall(log, stage, environment={'RAIN_SHARD_INDEX': str(index),
+                                                           'RAIN_SHARD_COUNT': str(count)}, timeout=timeout)
+
+        self.stage_status(states, shard, 'failed' if retval else 'done', exitcode=retval, ended=time.time())
+        if retval:
+            self.dump_tail(log)
+        return log.filename, retval
+
+    def subcall(self, logfile, target, environment=None, timeout=None):
+        """
+        Run rain.mk *target* in its own process group under the
+        supervisor, killing it after *timeout* or *timeouts[target]*
+        seconds if set, and with *limits* set on it and *environment*
+        added to its own.
+        """
         cmd = '{} {}'.format(self.buildscript, target)
         self.logger.info('%s - cd && %s', self.name, cmd)
-        return subprocess.call(shlex.split(cmd), stdout=logfile, stderr=logfile)
+        environment = dict(self.environment or {}, **(environment or {}))
+        env = dict(os.environ, **environment) if environment else None
+        supervisor = self.supervisor or rain.supervise.supervisor()
+        return supervisor.call(shlex.split(cmd), logfile, cwd=self.name, env=env,
+                               timeout=timeout or self.timeouts.get(target), name='{} {}'.format(self.name, target),
+                               limits=self.limits)
+
+    def dump_tail(self, logfile):
+        if isinstance(logfile, rain.logpipe.LogPipe):
+            filename = logfile.dump_tail()
+            if filename:
+                self.logger.error('%s - end of log in %s', self.name, filename)
+
+    def start(self):
+        """clear the directory, seed it if asked and name its log"""
+        with self.metrics.phase('clear'):
+            self.clear()
+
+        if self.seed:
+            self.logger.info('%s - seeding from %s', self.name, self.seed)
+            with self.metrics.phase('seed'):
+                method = clone_tree(self.seed, self.name, ignore=self.bookkeeping, **self.seed_options)
+            self.logger.debug('%s - seeded by %s', self.name, method)
+
+        self.status('incomplete')
+        self.log = rain.logpipe.LogPipe(os.path.join(self.name, 'Log-' + isodate()), **self.logconfig)
+
+    def logfile(self):
+        """
+        The build's log, which opens for appending each time it's
+        entered, so that populate and build can be run as separate
+        stages.
+        """
+        return self.log
+
+    def resume(self):
+        """build a directory populated by an earlier run, with a new log"""
+        self.logger.info('%s - resuming', self.name)
+        self.log = rain.logpipe.LogPipe(os.path.join(self.name, 'Log-' + isodate()), **self.logconfig)
+        with self.logfile() as logfile:
+            return self.build(logfile)
+
+    def run_variant(self, fingerprint=None, settings=None):
+        """
+        Build a tree already seeded by :py:meth:`start` from a
+        populated one, without populating again.  With a cache, the
+        build's fingerprint is that tree's *fingerprint* with the
+        variant's environment *settings*.
+        """
+        with self.logfile() as logfile:
+            if self.cache and fingerprint:
+                self.index.record(self.name, fingerprint=rain.cache.variant_fingerprint(fingerprint, settings or {}))
+            self.status('populated')
+            return self.build(logfile)
+
+    def run(self):
+        """
+        Clear, populate and build.  Doesn't change the current
+        directory so several of these can run at once.
+        """
+        self.start()
+        with self.logfile() as logfile:
+            retval = self.populate(logfile)
+
+            if retval:
+                retval = self.build(logfile)
+
+        return retval
+
+
+def build_loop(area, options, buildscript, gates=()):
+    """
+    Keep up to *options.jobs* working directories in flight until
+    *options.count* builds have been started.  The first
+    :py:class:`PopulationException` or :py:class:`BuildException`
+    stops the loop once the builds already running have finished,
+    while an interrupt cancels them.
+
+    Each of *gates* is called, and may block, before each new build
+    is started.
+    """
+    counter = options.count
+    retval = False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as pool:
+        pending = set()
+
+        try:
+            while pending or options.count == 0 or counter > 0:
+                while len(pending) < options.jobs and (options.count == 0 or counter > 0):
+                    counter -= 1
+
+                    for gate in gates:
+                        gate()
+
+                    wd = area.new_working_directory(buildscript)
+
+                    if options.keep != -1 or area.retaining: # minus one means "keep everything"
+                        with wd.metrics.phase('keep'):
+                            area.keep(options.keep)
+                    future = pool.submit(wd.run)
+                    future.add_done_callback(lambda f, wd=wd: area.release(wd))
+                    pending.add(future)
+
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    retval = future.result()
+
+        except KeyboardInterrupt:
+            area.cancel()
+            raise
+
+    return retval
+
+
+def matrix_loop(area, options, buildscript, matrix, gates=()):
+    """
+    Populate once for each of *options.count* builds, then build every
+    environment in *matrix* at once, each in its own clone of the
+    populated tree, by reflink where the file system can, and with its
+    own record, log and state.  The variants share the host's cores,
+    which rain.mk gets as RAIN_JOBS.
+
+    The populated tree is kept as a record of its own, in state
+    'populated', so later variants can be compared against it.
+    A variant which fails stops the loop once the others are done.
+    """
+    jobs = str(max(1, (os.cpu_count() or 1) // len(matrix)))
+    retval = False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(matrix)) as pool:
+        try:
+            for count in itertools.count():
+                if options.count and count >= options.count:
+                    break
+
+                for gate in gates:
+                    gate()
+
+                base = area.new_working_directory(buildscript)
+                if options.keep != -1 or area.retaining: # minus one means "keep everything"
+                    with base.metrics.phase('keep'):
+                        area.keep(options.keep)
+
+                try:
+                    base.start()
+                    with base.logfile() as logfile:
+                        base.populate(logfile)
+                    base.finished(0)
+                except:
+                    area.release(base)
+                    raise
+
+                row = area.index.get(base.name)
+                wds = []
+                try:
+                    for settings in matrix:
+                        label = ' '.join('{}={}'.format(name, value) for name, value in settings.items())
+                        wd = area.new_working_directory(buildscript, environment=dict(settings, RAIN_JOBS=jobs),
+                                                        seed=True, seed_from=base.name,
+                                                        seed_methods=('reflink', 'copy'))
+                        wds.append(wd)
+                        area.index.record(wd.name, variant=label)
+                        area.logger.info('%s - %s from %s', wd.name, label, base.name)
+
+                    # release base, which may spill it from memory, only once every variant is cloned
+                    starting = [pool.submit(wd.start) for wd in wds]
+                    concurrent.futures.wait(starting)
+                    for future in starting:
+                        future.result()
+
+                except:
+                    # no variant is built unless all are, so none is left half made
+                    for wd in wds:
+                        area.release(wd)
+                        if os.path.lexists(wd.name):
+                            area.remove(wd.name)
+                        else:
+                            area.index.forget(wd.name)
+                    raise
+
+                finally:
+                    area.release(base)
+
+                futures = []
+                for wd, settings in zip(wds, matrix):
+                    future = pool.submit(wd.run_variant, row['fingerprint'] if row else None, settings)
+                    future.add_done_callback(lambda f, wd=wd: area.release(wd))
+                    futures.append(future)
+
+                failure = None
+                for future in futures:
+                    try:
+                        retval = future.result()
+                    except BuildException as e:
+                        failure = failure or e
+
+                if failure:
+                    raise failure
+
+        except KeyboardInterrupt:
+            area.cancel()
+            raise
+
+    return retval
+
+
+def revisions(buildscript, good, bad):
+    """
+    Ask rain.mk for the revisions after *good* up to and including
+    *bad*, oldest first, one per line of ``rain.mk revisions GOOD BAD``.
+    """
+    output = subprocess.check_output([buildscript, 'revisions', good, bad], universal_newlines=True)
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def bisect_loop(area, options, buildscript, good, bad):
+    """
+    Find the first revision after *good* up to *bad* whose build
+    fails, taking *good* to build and *bad* to fail.  Each round builds
+    up to *options.jobs* revisions spread evenly over those still in
+    question, so each round cuts them by a factor of jobs + 1.
+
+    Builds get the revision as RAIN_REVISION for rain.mk populate.
+    They are seeded from the last good build by reflink where the file
+    system can, or as usual with *options.seed*.  Revisions which fail
+    to populate are skipped.  Every build records its revision, and the
+    builds either side of the change record 'last good' and 'first bad'.
+
+    :return: the first bad revision, or None.
+    """
+    candidates = revisions(buildscript, good, bad)
+    if not candidates:
+        area.logger.error('no revisions between %s and %s', good, bad)
+        return None
+
+    order = dict((revision, i) for i, revision in enumerate(candidates))
+    tested = {}
+    skipped = set()
+    lo, hi = -1, len(candidates) - 1
+
+    def test(revision):
+        wd = area.new_working_directory(buildscript, environment={'RAIN_REVISION': revision}, seed=True,
+                                        seed_methods=None if area.seed else ('reflink',))
+        area.index.record(wd.name, revision=revision)
+        future = pool.submit(wd.run)
+        future.add_done_callback(lambda f, wd=wd: area.release(wd))
+        return wd.name, future
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as pool:
+        try:
+            while hi - lo > 1:
+                points = sorted(set(lo + (hi - lo) * (j + 1) // (options.jobs + 1) for j in range(options.jobs))
+                                - set([lo, hi]))
+                area.logger.info('bisecting %s revisions, testing %s', hi - lo - 1,
+                                 ', '.join(candidates[point] for point in points))
+
+                running = dict((point, test(candidates[point])) for point in points)
+                results = {}
+                for point, (name, future) in sorted(running.items()):
+                    try:
+                        future.result()
+                        results[point] = 'good'
+                    except BuildException:
+                        results[point] = 'bad'
+                    except PopulationException:
+                        results[point] = 'skip'
+                    tested[candidates[point]] = name
+                    area.logger.info('%s: %s', candidates[point], results[point])
+
+                bads = [point for point in points if results[point] == 'bad']
+                if bads:
+                    hi = min(bads)
+                goods = [point for point in points if results[point] == 'good' and point < hi]
+                if goods:
+                    lo = max(goods)
+
+                # forget skipped revisions and renumber what's left
+                skipped.update(candidates[point] for point in points if results[point] == 'skip')
+                low, high = candidates[lo] if lo >= 0 else None, candidates[hi]
+                candidates = [revision for revision in candidates if revision not in skipped]
+                lo = candidates.index(low) if low else -1
+                hi = candidates.index(high)
+
+        except KeyboardInterrupt:
+            area.cancel()
+            raise
+
+    culprit = candidates[hi]
+    doubt = [revision for revision in skipped
+             if (order[candidates[lo]] if lo >= 0 else -1) < order[revision] < order[culprit]]
+    if doubt:
+        area.logger.warning('%s or one of the skipped %s is the first bad revision', culprit, ', '.join(doubt))
+
+    if culprit in tested:
+        area.index.record(tested[culprit], bisect='first bad')
+    if lo >= 0 and candidates[lo] in tested:
+        area.index.record(tested[candidates[lo]], bisect='last good')
+
+    return culprit
+
+
+def resume_loop(area, options, buildscript):
+    """
+    Build every directory :py:meth:`WorkArea.resumable` finds, up to
+    *options.jobs* at once.
+    """
+    retval = False
+    dirs = area.resumable()
+    if not dirs:
+        area.logger.info('nothing to resume')
+        return retval
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as pool:
+        pending = set()
+        for dir in dirs:
+            wd = area.resume_working_directory(dir, buildscript)
+            future = pool.submit(wd.resume)
+            future.add_done_callback(lambda f, wd=wd: area.release(wd))
+            pending.add(future)
+
+        try:
+            for future in concurrent.futures.as_completed(pending):
+                retval = future.result()
+
+        except KeyboardInterrupt:
+            area.cancel()
+            raise
+
+    return retval
+
+
+def pipeline_loop(area, options, buildscript, gates=()):
+    """
+    Like :py:func:`build_loop` but split into two stages.  A populate
+    thread runs ahead of the builds, leaving up to *options.pipeline*
+    populated working directories in a queue while the main thread
+    builds them one at a time.  Population failures are passed down
+    the queue so that builds already populated still happen first.
+    """
+    populated = queue.Queue(maxsize=options.pipeline)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                populated.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def populate_stage():
+        counter = options.count
+        try:
+            while not stop.is_set() and (options.count == 0 or counter > 0):
+                counter -= 1
+
+                for gate in gates:
+                    gate()
+
+                wd = area.new_working_directory(buildscript)
+
+                if options.keep != -1 or area.retaining: # minus one means "keep everything"
+                    with wd.metrics.phase('keep'):
+                        area.keep(options.keep)
+
+                try:
+                    wd.start()
+                    with wd.logfile() as logfile:
+                        wd.populate(logfile)
+                except:
+                    area.release(wd)
+                    raise
+
+                put(wd)
+
+        except Exception as e:
+            put(e)
+
+        else:
+            put(None)
+
+    populator = threading.Thread(target=populate_stage, name='populate')
+    populator.start()
+
+    retval = False
+    try:
+        while True:
+            wd = populated.get()
+            if wd is None:
+                break
+
+            if isinstance(wd, Exception):
+                raise wd
+
+            try:
+                with wd.logfile() as logfile:
+                    retval = wd.build(logfile)
+            finally:
+                area.release(wd)
+
+    except KeyboardInterrupt:
+        area.cancel()
+        raise
+
+    finally:
+        stop.set()
+        populator.join()
+
+    return retval
+
+
+def answer(area, action, count=1):
+    """
+    The output of the queries :py:mod:`rain.daemon` answers, which is
+    the same whether a daemon answers or not.
+    """
+    if action == 'ls':
+        return '\n'.join(area.raindirs())
+
+    elif action == 'status':
+        rows = area.index.rows()
+        if count > 0:
+            rows = rows[-count:]
+        return '\n'.join('{}\t{}\t{}{}'.format(row['name'], row['state'],
+                                                '' if row['exitcode'] is None else row['exitcode'],
+                                                '\tarchived' if row['archive'] else '')
+                         for row in rows)
+
+    elif action == 'keep':
+        area.keep(count)
+        return ''
+
+    raise ValueError('{} is not a query'.format(action))
+
+
+def daemon_loop(area, options, buildscript, gates=(), watcher=None):
+    """
+    Answer clients on :py:data:`rain.daemon.socket_name` and build
+    whenever one triggers a build, or *watcher* sees a change, until
+    interrupted or terminated.  Builds run as in :py:func:`build_loop`
+    but failures are logged rather than ending the loop.
+    """
+    server = rain.daemon.Server(lambda action, count=1: answer(area, action, count), area.logger,
+                                settings=rain.daemon.settings(options))
+    server.start()
+
+    if watcher:
+        def watch():
+            while True:
+                watcher.wait()
+                server.trigger()
+
+        thread = threading.Thread(target=watch, name='watch')
+        thread.daemon = True
+        thread.start()
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    forever = argparse.Namespace(**dict(vars(options), count=0))
+    try:
+        while True:
+            try:
+                build_loop(area, forever, buildscript, [server.wait] + list(gates))
+            except (PopulationException, BuildException):
+                area.logger.warning('build failed, waiting for the next trigger')
+
+    except KeyboardInterrupt:
+        area.logger.info('stopping.')
+        return False
+
+    finally:
+        server.stop()
 
 
 def main():
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%dT%H:%M:%S%z')
     logger = logging.getLogger()
 
-    options = _parse_args()
+    options = rain.options.parse()
+
+    if options.action in rain.daemon.actions:
+        response = rain.daemon.request(options.action, count=options.count,
+                                       settings=rain.daemon.settings(options))
+        if response is not None:
+            if response['output']:
+                print(response['output'])
+            return response['status']
 
     log_level = logging.INFO
 
@@ -151,78 +1615,203 @@ def main():
 
     logger.setLevel(log_level)
 
-    area = WorkArea(logger)
+    roots = options.root or ['.']
 
-    if options.action in ['build']:
+    # a one shot removal only moves builds to the trash, which the next
+    # build reaps, rather than wait for them to go
+    reaper = None
+    if not options.sync_remove and options.action in builders + ['keep'] + rain.options.removal_cmds:
+        reaper = Reaper(logger, throttle=options.reap_throttle, ionice=options.reap_ionice, roots=roots)
+        if options.action in builders:
+            reaper.start()
+
+    logconfig = {
+        'compress': None if options.log_compress == 'none' else options.log_compress,
+        'cap': int(options.log_cap * 1024 * 1024) if options.log_cap else None,
+        'tail': int(options.log_tail * 1024 * 1024),
+    }
+
+    if options.spares:
+        for root in roots:
+            for leftover in glob.glob(os.path.join(root, spare_prefix + '-*')):
+                if reaper:
+                    reaper.discard(leftover)
+                else:
+                    shutil.rmtree(leftover)
+
+    # a matrix has its populated tree and every variant at once
+    size = options.jobs + options.pipeline + 1
+    if options.matrix:
+        size = max(size, len(rain.options.variants(options.matrix)) + 1)
+
+    locations = [rain.Location(root, logger=logger, size=size,
+                               spares=options.spares, prefix=spare_prefix)
+                 for root in roots]
+
+    location = None
+    scheduler = None
+    if len(locations) > 1:
+        scheduler = rain.Scheduler(locations, min_free=int(options.min_free * 1024 ** 3))
+    elif options.spares or roots != ['.']:
+        location = locations[0]
+
+    memory = None
+    if options.tmpfs:
+        memory = rain.MemoryRoot(options.tmpfs, budget=int(options.tmpfs_budget * 1024 ** 3),
+                                 reserve=int(options.tmpfs_reserve * 1024 ** 3), logger=logger)
+
+    shared_cache = None
+    if options.shared_cache:
+        shared_cache = rain.cache.SharedCache(options.shared_cache, int(options.shared_cache_size * 1024 ** 3),
+                                              logger)
+        shared_cache.start()
+
+    supervisor = rain.supervise.Supervisor(grace=options.kill_grace)
+
+    limits = {}
+    if options.limit_as:
+        limits[resource.RLIMIT_AS] = int(options.limit_as * 1024 ** 3)
+    if options.limit_files:
+        limits[resource.RLIMIT_NOFILE] = options.limit_files
+
+    logindex = None
+    if options.index_logs:
+        logindex = rain.logindex.LogIndex()
+
+    area = WorkArea(logger, seed=options.seed, reaper=reaper, cache=options.cache, logconfig=logconfig,
+                    prometheus=options.prometheus, location=location, scheduler=scheduler, roots=roots,
+                    memory=memory, spill=options.tmpfs_spill, shared_cache=shared_cache,
+                    archive_after=None if options.archive_after < 0 else options.archive_after,
+                    archive_globs=options.archive_glob,
+                    max_age=options.keep_days * 24 * 60 * 60 if options.keep_days else None,
+                    budget=int(options.keep_size * 1024 ** 3) if options.keep_size else None,
+                    keep_good=options.keep_good, supervisor=supervisor,
+                    timeouts=dict(options.stage_timeout, populate=options.populate_timeout or None,
+                                  build=options.build_timeout or None),
+                    limits=limits, logindex=logindex, shard_target=options.shard_target or None,
+                    stages=options.stages, readonly=options.action in queries)
+
+    if logindex:
+        logindex.start(area.index.rows)
+
+    try:
+        return do_action(area, options, logger)
+
+    finally:
+        supervisor.stop()
+
+        if logindex:
+            logindex.stop()
+
+        if shared_cache:
+            shared_cache.stop()
+
+        for location in locations:
+            location.close()
+
+        if reaper:
+            reaper.stop()
+
+
+def do_action(area, options, logger):
+    if options.action in builders:
 
-        # do stuff
-        counter = options.count
         mkfile = 'rain.mk'
 
-        while options.count == 0 or counter > 0:
-            counter -= 1
+        if not os.path.exists(mkfile):
+            logger.error('No %s', mkfile)
+            return 1
 
-            if options.keep != -1: # minus one means "keep everything"
-                area.keep(options.keep)
+        buildscript = os.path.abspath(mkfile)
+        if options.action in ['resume']:
+            return resume_loop(area, options, buildscript)
 
-            wd = area.new_working_directory('../{}'.format(mkfile))
-            wd.clear()
+        if options.action in ['bisect']:
+            if len(options.arguments) != 2:
+                logger.error('bisect needs a good and a bad revision')
+                return 1
 
-            if not os.path.exists(mkfile):
-                logger.error('No %s', mkfile)
+            culprit = bisect_loop(area, options, buildscript, *options.arguments)
+            if not culprit:
                 return 1
 
-            with wd.pushdir():
-                wd.status('incomplete')
-                with open('Log-' + isodate(), 'w') as logfile:
-                    retval = wd.populate(logfile)
+            print(culprit)
+            return False
 
-                    if retval:
-                        retval = wd.build(logfile)
+        gates = []
+        watcher = None
 
-        return retval
+        if options.watch or options.watch_touch or options.watch_poll:
+            watcher = rain.trigger.Watcher(logger, paths=options.watch, touchfile=options.watch_touch,
+                                           pollcmd='{} poll'.format(buildscript) if options.watch_poll else None,
+                                           interval=options.watch_poll, debounce=options.debounce)
 
-    elif options.action in ['ls']:
-        stuff = '\n'.join(raindirs())
-        if stuff:
-            print(stuff)
+        if options.admit_load or options.admit_memory or options.admit_free:
+            admission = rain.Admission(logger,
+                                       max_load=options.admit_load or None,
+                                       min_memory=int(options.admit_memory * 1024 ** 3) or None,
+                                       min_free=int(options.admit_free * 1024 ** 3) or None,
+                                       paths=area.roots, backoff=options.admit_backoff,
+                                       max_backoff=max(options.admit_backoff, options.admit_max_backoff))
+            gates.append(admission.wait)
 
-    elif options.action in ['keep']:
-        area.keep(options.count)
+        if options.action in ['daemon']:
+            return daemon_loop(area, options, buildscript, gates, watcher)
 
-    elif options.action in removal_cmds:
-        for dir in area.raindirs()[:options.count]:
-            shutil.rmtree(dir)
+        if watcher:
+            gates.insert(0, watcher.wait)
 
-    return False
+        if options.matrix:
+            return matrix_loop(area, options, buildscript, rain.options.variants(options.matrix), gates)
 
+        if options.pipeline:
+            return pipeline_loop(area, options, buildscript, gates)
 
-def _parse_args():
-    """
-    Parses the command line arguments.
+        return build_loop(area, options, buildscript, gates)
 
-    :return: Namespace with arguments.
-    :rtype: Namespace
-    """
-    parser = argparse.ArgumentParser(description='rain - a new sort of automated builder.')
-    
-    parser.add_argument('action', help='what shall we do?', default='build', nargs='?',
-                        choices=['build',
-                                 'ls',
-                                 'keep'] + removal_cmds)
+    elif options.action in ['ls', 'status', 'keep']:
+        stuff = answer(area, options.action, options.count)
+        if stuff:
+            print(stuff)
+
+    elif options.action in ['reindex']:
+        area.reindex()
+
+    elif options.action in ['grep', 'first-seen']:
+        if len(options.arguments) != 1:
+            logger.error('%s needs one pattern', options.action)
+            return 1
+
+        pattern = options.arguments[0]
+        logindex = area.logindex or rain.logindex.LogIndex()
+        logindex.update(area.index.rows())
+        if options.action in ['grep']:
+            for name, log, lineno, text in logindex.search(pattern):
+                print('{}:{}:{}'.format(log, lineno, text))
+        else:
+            name = logindex.first_seen(pattern)
+            if name:
+                print(name)
 
-    parser.add_argument('-c', '--count', type=int, default=1,
-                        help='a count of items on which to operate. [default: %(default)s]')
+    elif options.action in ['extract']:
+        for name in options.arguments:
+            dir = area.find(name)
+            if not dir:
+                logger.error('No build %s', name)
+                return 1
 
-    parser.add_argument('--keep', type=int, default=-1,
-                        help='how many builds should we keep around? [default: %(default)s]')
+            try:
+                area.extract(dir)
+            except (ValueError, IOError) as e:
+                logger.error('%s', e)
+                return 1
 
-    parser.add_argument('-v', '--verbose', action='count', default=0, help='Be more verbose. (can be repeated)')
+    elif options.action in rain.options.removal_cmds:
+        for dir in area.raindirs()[:options.count]:
+            area.remove(dir)
 
-    parser.add_argument('--version', default=False, action='store_true',
-                        help='print version number and exit. [default: %(default)s]')
+    return False
 
-    return parser.parse_args()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+Per phase timing and resource use of builds, written as json next to
+each build's *.rain* and, optionally, as a prometheus text file for
+node_exporter's textfile collector.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+
+class Metrics:
+    """
+    Timings for the phases of one build.
+
+    Child resource use comes from deltas of
+    ``getrusage(RUSAGE_CHILDREN)``, which covers every child the
+    process has waited for, so when several builds run at once each
+    build's figures include children of the others which finished in
+    the same interval.  *maxrss* is the largest child so far rather
+    than a delta.
+    """
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self.phases[name] = {
+                'wall': time.time() - start,
+                'utime': after.ru_utime - before.ru_utime,
+                'stime': after.ru_stime - before.ru_stime,
+                'maxrss': after.ru_maxrss * 1024,
+                'inblock': after.ru_inblock - before.ru_inblock,
+                'oublock': after.ru_oublock - before.ru_oublock,
+            }
+
+    def as_dict(self):
+        return {'phases': self.phases}
+
+    def write_json(self, filename, **extra):
+        record = self.as_dict()
+        record.update(extra)
+        with open(filename, 'w') as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+prometheus_lock = threading.Lock()
+
+# metric name, phase key, help, multiplier
+prometheus_metrics = [
+    ('rain_phase_wall_seconds', 'wall', 'Wall clock time of each phase of the last build.', 1),
+    ('rain_phase_user_seconds', 'utime', 'User CPU time of child processes in each phase of the last build.', 1),
+    ('rain_phase_system_seconds', 'stime', 'System CPU time of child processes in each phase of the last build.', 1),
+    ('rain_phase_max_rss_bytes', 'maxrss', 'Largest child resident set size by the end of each phase.', 1),
+    ('rain_phase_read_bytes', 'inblock', 'Block input by child processes in each phase of the last build.', 512),
+    ('rain_phase_write_bytes', 'oublock', 'Block output by child processes in each phase of the last build.', 512),
+]
+
+def write_prometheus(filename, metrics, state, ended=None):
+    """
+    Atomically replace *filename* with the metrics of the last build
+    to finish in prometheus text exposition format.
+    """
+    lines = []
+    for name, key, help, multiplier in prometheus_metrics:
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} gauge'.format(name))
+        for phase, values in metrics.phases.items():
+            lines.append('{}{{phase="{}"}} {}'.format(name, phase, values[key] * multiplier))
+
+    lines.append('# HELP rain_last_build_success Whether the last build to finish succeeded.')
+    lines.append('# TYPE rain_last_build_success gauge')
+    lines.append('rain_last_build_success {}'.format(1 if state in ['built', 'cached'] else 0))
+    lines.append('# HELP rain_last_build_end_timestamp_seconds When the last build finished.')
+    lines.append('# TYPE rain_last_build_end_timestamp_seconds gauge')
+    lines.append('rain_last_build_end_timestamp_seconds {}'.format(time.time() if ended is None else ended))
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    with prometheus_lock:
+        fd, tmpname = tempfile.mkstemp(dir=directory, prefix='.rain-prom-')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.chmod(tmpname, 0o644)
+        os.rename(tmpname, filename)
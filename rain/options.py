@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+rain's command line, kept apart from :py:mod:`rain.main` and to the
+standard library so that the :py:mod:`rain.daemon` client can parse
+it exactly as rain does without importing everything rain builds
+with.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import argparse
+import collections
+import itertools
+
+removal_cmds = ['remove', 'rm', 'delete', 'del']
+
+# how many entries the reaper removes between pauses
+reap_batch = 100
+
+
+def variants(specs):
+    """
+    The environments of a build matrix, one for every combination of
+    the values in *specs*, each like ``CC=gcc,clang``.
+
+    :raises ValueError: on a spec without a name or values.
+    """
+    axes = []
+    for spec in specs:
+        name, sep, values = spec.partition('=')
+        values = [value for value in values.split(',') if value]
+        if not sep or not name or not values:
+            raise ValueError('matrix axis "{}" is not like NAME=VALUE,VALUE'.format(spec))
+        axes.append([(name, value) for value in values])
+
+    return [collections.OrderedDict(combination) for combination in itertools.product(*axes)]
+
+
+def matrix_axis(spec):
+    """an argparse type for one --matrix axis"""
+    try:
+        variants([spec])
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+    return spec
+
+
+def stage_timeout(spec):
+    """an argparse type for one --stage-timeout, as a (name, seconds) pair"""
+    name, sep, seconds = spec.partition('=')
+    try:
+        seconds = float(seconds)
+    except ValueError:
+        seconds = None
+    if not sep or not name or not seconds or seconds < 0:
+        raise argparse.ArgumentTypeError('stage timeout "{}" is not like NAME=SECONDS'.format(spec))
+
+    return name, seconds
+
+
+def parse(args=None):
+    """
+    Parses the command line arguments, *args* or else sys.argv.
+
+    :return: Namespace with arguments.
+    :rtype: Namespace
+    """
+    parser = argparse.ArgumentParser(description='rain - a new sort of automated builder.')
+
+    parser.add_argument('action', help='what shall we do?', default='build', nargs='?',
+                        choices=['build',
+                                 'resume',
+                                 'daemon',
+                                 'trigger',
+                                 'status',
+                                 'ls',
+                                 'keep',
+                                 'reindex',
+                                 'extract',
+                                 'grep',
+                                 'first-seen',
+                                 'bisect'] + removal_cmds)
+
+    parser.add_argument('arguments', nargs='*', default=[], metavar='ARG',
+                        help='the builds to extract, the text to grep for or find first, or the good and'
+                        ' bad revisions to bisect between.  Bisecting needs "rain.mk revisions GOOD BAD" to'
+                        ' list the revisions in between and "rain.mk populate" to honor RAIN_REVISION.')
+
+    parser.add_argument('-c', '--count', type=int, default=1,
+                        help='a count of items on which to operate. [default: %(default)s]')
+
+    parser.add_argument('--keep', type=int, default=-1,
+                        help='how many builds should we keep around? [default: %(default)s]')
+
+    parser.add_argument('--keep-days', type=float, default=0, metavar='DAYS',
+                        help='also remove builds which ended more than DAYS ago.  0 means no limit.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--keep-size', type=float, default=0, metavar='GB',
+                        help='also remove the oldest builds until the rest, as recorded in the index, total'
+                        ' less than GB.  0 means no limit. [default: %(default)s]')
+
+    parser.add_argument('--keep-good', default=False, action='store_true',
+                        help='never remove the newest good build, nor the first failed build after it.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='how many builds to run at once. [default: %(default)s]')
+
+    parser.add_argument('--matrix', default=[], action='append', type=matrix_axis, metavar='NAME=VALUE,VALUE',
+                        help='populate once, then build in a clone for every combination of these environment'
+                        ' variables at once, sharing the cores between them as RAIN_JOBS.'
+                        '  May be repeated. [default: %(default)s]')
+
+    parser.add_argument('--pipeline', type=int, default=0, metavar='DEPTH',
+                        help='populate the next builds while building this one, keeping up to DEPTH'
+                        ' populated directories waiting.  Builds run one at a time. [default: %(default)s]')
+
+    parser.add_argument('--seed', default=False, action='store_true',
+                        help='start each build from a clone of the last good build rather than an empty'
+                        ' directory.  Uses reflinks where possible, otherwise hard links, so rain.mk'
+                        ' must replace files rather than edit them in place. [default: %(default)s]')
+
+    parser.add_argument('--cache', default=None, choices=['skip', 'link'],
+                        help='skip the build when the populated tree and rain.mk match an earlier good'
+                        ' build, marking it "cached".  "link" also hard links the earlier build\'s'
+                        ' outputs in. [default: %(default)s]')
+
+    parser.add_argument('--populate-timeout', type=float, default=0, metavar='SECONDS',
+                        help='kill "rain.mk populate", and everything it started, after this long.'
+                        '  0 means no limit. [default: %(default)s]')
+
+    parser.add_argument('--build-timeout', type=float, default=0, metavar='SECONDS',
+                        help='kill "rain.mk build", or with --stages each stage or shard after populate, and'
+                        ' everything it started, after this long.  0 means no limit. [default: %(default)s]')
+
+    parser.add_argument('--stage-timeout', default=[], action='append', type=stage_timeout, metavar='NAME=SECONDS',
+                        help='kill stage NAME, or each of its shards, after SECONDS rather than --build-timeout.'
+                        ' (can be repeated)')
+
+    parser.add_argument('--stages', default=False, action='store_true',
+                        help='build in the stages "rain.mk stages" declares, each as soon as those it depends on'
+                        ' are done.  Without, or if rain.mk declares none, build is the one stage.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--shard-target', type=float, default=60, metavar='SECONDS',
+                        help='run sharded stages in enough shards, up to the number declared, for each to take'
+                        ' about this long, going by their last run.  0 always runs the number declared.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--kill-grace', type=float, default=10, metavar='SECONDS',
+                        help='when killing rain.mk, wait this long after SIGTERM before SIGKILL.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--admit-load', type=float, default=0, metavar='LOAD',
+                        help='hold off starting a build while the one minute load average is over LOAD.'
+                        '  0 disables. [default: %(default)s]')
+
+    parser.add_argument('--admit-memory', type=float, default=0, metavar='GB',
+                        help='hold off starting a build while MemAvailable is under GB.  0 disables.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--admit-free', type=float, default=0, metavar='GB',
+                        help='hold off starting a build while any root has less than GB free.  0 disables.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--admit-backoff', type=float, default=5, metavar='SECONDS',
+                        help='when holding off, check again after this long, doubling each time.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--admit-max-backoff', type=float, default=60, metavar='SECONDS',
+                        help='the longest wait between checks when holding off. [default: %(default)s]')
+
+    parser.add_argument('--limit-as', type=float, default=0, metavar='GB',
+                        help='cap the address space of rain.mk and each of its children.  0 means no limit.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--limit-files', type=int, default=0, metavar='COUNT',
+                        help='cap the open files of rain.mk and each of its children.  0 means no limit.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--watch', default=[], action='append', metavar='PATH',
+                        help='after the first build, wait for a change under PATH before each build.'
+                        ' (can be repeated)')
+
+    parser.add_argument('--watch-touch', default=None, metavar='FILE',
+                        help='after the first build, wait for FILE to be touched before each build.')
+
+    parser.add_argument('--watch-poll', type=float, default=0, metavar='SECONDS',
+                        help='after the first build, run "rain.mk poll" this often and wait for it to'
+                        ' print "changed" before each build.  0 disables. [default: %(default)s]')
+
+    parser.add_argument('--debounce', type=float, default=5, metavar='SECONDS',
+                        help='once triggered, wait for this long without further triggers before'
+                        ' building. [default: %(default)s]')
+
+    parser.add_argument('--log-compress', default='none', choices=['none', 'gzip', 'zstd'],
+                        help='compress build logs as they are written. [default: %(default)s]')
+
+    parser.add_argument('--log-cap', type=float, default=0, metavar='MB',
+                        help='stop writing a build log after this many megabytes of output.'
+                        '  0 means no limit. [default: %(default)s]')
+
+    parser.add_argument('--log-tail', type=float, default=1, metavar='MB',
+                        help='keep this much of the end of each log in memory and write it,'
+                        ' uncompressed, to Log-*.tail when populate or build fails. [default: %(default)s]')
+
+    parser.add_argument('--index-logs', default=False, action='store_true',
+                        help='add each build\'s logs to the full text index in .rain-logs.db as it finishes,'
+                        ' rather than when grep or first-seen next runs. [default: %(default)s]')
+
+    parser.add_argument('--prometheus', default=None, metavar='FILE',
+                        help='write the phase timings of each build to finish to FILE in prometheus'
+                        ' text format, for node_exporter\'s textfile collector.')
+
+    parser.add_argument('--spares', type=int, default=0,
+                        help='keep this many empty working directories made ahead of time so that'
+                        ' starting a build is a rename. [default: %(default)s]')
+
+    parser.add_argument('--root', default=[], action='append', metavar='DIR',
+                        help='put builds under DIR rather than the current directory.  When repeated,'
+                        ' each build goes to the root with the fewest builds on its device, then the'
+                        ' least busy device, then the most free space.')
+
+    parser.add_argument('--min-free', type=float, default=1, metavar='GB',
+                        help='with several roots, skip roots with less free space than this.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--tmpfs', default=None, metavar='DIR',
+                        help='run builds in DIR, typically a tmpfs, when earlier builds by the same rain.mk'
+                        ' fit the memory budget, and move them to disk when done.')
+
+    parser.add_argument('--tmpfs-budget', type=float, default=4, metavar='GB',
+                        help='total expected size of builds running in --tmpfs at once. [default: %(default)s]')
+
+    parser.add_argument('--tmpfs-reserve', type=float, default=1, metavar='GB',
+                        help='build on disk instead if memory available would drop below this.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--tmpfs-spill', default='move', choices=['move', 'archive'],
+                        help='when a build in --tmpfs is done, move it to disk, or keep only its status'
+                        ' and logs plus a tree.tar.gz of the rest. [default: %(default)s]')
+
+    parser.add_argument('--shared-cache', default=None, metavar='DIR',
+                        help='a cache directory shared by all builds, exported to rain.mk as RAIN_CACHE,'
+                        ' RAIN_DOWNLOADS, CCACHE_DIR and PIP_CACHE_DIR, with CCACHE_STATSLOG in each build'
+                        ' for counting its ccache hits and misses.')
+
+    parser.add_argument('--shared-cache-size', type=float, default=20, metavar='GB',
+                        help='evict the least recently used files in --shared-cache beyond this size.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('--archive-after', type=int, default=-1, metavar='N',
+                        help='of the builds kept, replace all but the newest N with compressed archives of'
+                        ' their status, logs and --archive-glob files.  -1 never archives. [default: %(default)s]')
+
+    parser.add_argument('--archive-glob', default=[], action='append', metavar='PATTERN',
+                        help='also archive files whose path within the build matches PATTERN. (can be repeated)')
+
+    parser.add_argument('--sync-remove', default=False, action='store_true',
+                        help='remove old builds inline rather than moving them to .rain-trash'
+                        ' for a background thread to remove. [default: %(default)s]')
+
+    parser.add_argument('--reap-throttle', type=float, default=0, metavar='SECONDS',
+                        help='pause this long after every {} entries removed in the background.'
+                        ' [default: %(default)s]'.format(reap_batch))
+
+    parser.add_argument('--reap-ionice', type=int, default=3, choices=[0, 1, 2, 3], metavar='CLASS',
+                        help='ionice scheduling class for background removal, 0 leaves it alone.'
+                        ' [default: %(default)s]')
+
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='Be more verbose. (can be repeated)')
+
+    parser.add_argument('--version', default=False, action='store_true',
+                        help='print version number and exit. [default: %(default)s]')
+
+    return parser.parse_args(args)
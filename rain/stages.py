@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+Build stages declared by rain.mk.
+
+With ``--stages``, rain asks ``rain.mk stages``, which prints one line
+per stage, its name, a colon and the stages it depends on, like a make
+rule::
+
+    configure:
+    build: configure
+    test-unit: build
+    test-integration: build
+    package: test-unit test-integration
+
+populate always runs first, on its own, so it needn't be declared and
+is ignored as a dependency.  A rain.mk which fails, prints nothing
+with a colon in it, as a script echoing its target would, or prints
+something which doesn't parse, has the one stage, build.
+
+A stage declared as ``test/8:`` is sharded: it runs as up to 8 copies
+at once in the same tree, each with ``RAIN_SHARD_INDEX`` and
+``RAIN_SHARD_COUNT`` in its environment, and succeeds when every shard
+does.  Other stages refer to it as plain ``test``.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import collections
+import hashlib
+import math
+
+# states of a stage, as written to .rain.stages
+good_states = ['done', 'cached']
+
+class StageError(ValueError):
+    pass
+
+class Graph(collections.OrderedDict):
+    """
+    Stage to the list of stages it depends on, in the order declared,
+    with the most shards of each sharded stage in *shards*.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shards = {}
+
+def parse(text):
+    """
+    :return: a :py:class:`Graph` of the stages *text* declares, or None
+        if it declares none.
+    """
+    lines = [line.split('#', 1)[0].strip() for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    if not any(':' in line for line in lines):
+        return None
+
+    graph = Graph()
+    for line in lines:
+        if ':' not in line:
+            raise StageError('no colon in stage declaration "{}"'.format(line))
+
+        name, deps = line.split(':', 1)
+        name = name.strip()
+        if '/' in name:
+            name, count = name.split('/', 1)
+            if not count.isdigit() or int(count) < 1:
+                raise StageError('bad shard count in stage declaration "{}"'.format(line))
+            graph.shards[name] = int(count)
+
+        if name == 'populate':
+            continue
+
+        graph.setdefault(name, [])
+        graph[name].extend(dep for dep in deps.split() if dep != 'populate' and dep not in graph[name])
+
+    return graph or None
+
+def order(graph):
+    """
+    :return: the stages of *graph* with every stage after those it
+        depends on.
+    :raises StageError: on unknown dependencies or cycles.
+    """
+    for name, deps in graph.items():
+        for dep in deps:
+            if dep not in graph:
+                raise StageError('{} depends on undeclared stage {}'.format(name, dep))
+
+    ordered = []
+    visiting = set()
+
+    def visit(name):
+        if name in ordered:
+            return
+        if name in visiting:
+            raise StageError('stage {} depends on itself'.format(name))
+
+        visiting.add(name)
+        for dep in graph[name]:
+            visit(dep)
+        visiting.discard(name)
+        ordered.append(name)
+
+    for name in graph:
+        visit(name)
+
+    return ordered
+
+def keys(graph, fingerprint):
+    """
+    :return: a dict of stage to a digest of its inputs, which are the
+        populated tree's *fingerprint* and the inputs of the stages it
+        depends on.
+    """
+    result = {}
+    for name in order(graph):
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update('{}\0{}\0'.format(fingerprint, name).encode('utf-8'))
+        for dep in sorted(graph[name]):
+            digest.update(result[dep].encode('utf-8') + b'\0')
+        result[name] = digest.hexdigest()
+
+    return result
+
+def shard_count(most, durations, target):
+    """
+    :return: how many shards to run a stage in, at most *most*, so that
+        each takes about *target* seconds going by the *durations* of
+        the shards of its last run, or *most* without any.
+    """
+    if not durations or not target:
+        return most
+
+    return max(1, min(most, int(math.ceil(sum(durations) / target))))
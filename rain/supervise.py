@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+Supervision of rain.mk subprocesses.  Each runs in its own process
+group so that a timeout or cancellation can reach everything it
+started, like make's workers, and one asyncio event loop in a
+background thread watches them all.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import asyncio
+import logging
+import os
+import resource
+import select
+import signal
+import subprocess
+import threading
+import time
+
+import rain.logpipe
+
+logger = logging.getLogger(__name__)
+
+chunk_size = 64 * 1024
+
+def set_limits(limits):
+    """a preexec_fn setting both soft and hard *limits*"""
+    def preexec():
+        for limit, value in limits.items():
+            resource.setrlimit(limit, (value, value))
+
+    return preexec
+
+class Supervisor:
+    """
+    Runs commands for any number of threads at once on one event loop.
+
+    :py:meth:`call` blocks its caller until the command finishes, or
+    until *timeout* seconds have passed, when the command's process
+    group is sent SIGTERM and, if it hasn't gone after *grace* seconds,
+    SIGKILL.  :py:meth:`cancel` does the same to every command running
+    and refuses new ones.
+    """
+
+    # seconds to keep reading output after a command exits
+    drain = 0.5
+
+    def __init__(self, grace=10):
+        self.grace = grace
+        self.loop = None
+        self.thread = None
+        self.running = set()
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name='supervisor')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            if not self.thread:
+                return
+
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.thread = self.loop = None
+
+    def call(self, cmd, log, cwd=None, env=None, timeout=None, name=None, limits=None):
+        """
+        Run *cmd* with its output going to *log*, a
+        :py:class:`rain.logpipe.LogPipe` or a file, and with *limits*, a
+        dict of :py:mod:`resource` limits to values, set in the child.
+
+        :return: the exit status, negative if killed by a signal.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.supervise(cmd, log, cwd, env, timeout, name or cmd[0], limits),
+                                                self.loop).result()
+
+    def cancel(self):
+        """kill everything running and refuse anything more"""
+        self.cancelled = True
+        if self.thread:
+            asyncio.run_coroutine_threadsafe(self.terminate_all(), self.loop).result()
+
+    async def supervise(self, cmd, log, cwd, env, timeout, name, limits=None):
+        if self.cancelled:
+            return -signal.SIGTERM
+
+        piped = isinstance(log, rain.logpipe.LogPipe)
+        if piped:
+            reader, writer = os.pipe()
+
+        try:
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=writer if piped else log,
+                                                        stderr=subprocess.STDOUT, cwd=cwd, env=env,
+                                                        start_new_session=True,
+                                                        preexec_fn=set_limits(limits) if limits else None)
+        except:
+            if piped:
+                os.close(reader)
+            raise
+
+        finally:
+            if piped:
+                os.close(writer)
+
+        self.running.add(proc)
+        try:
+            pumped, exited = self.start_pump(reader, log) if piped else (None, None)
+
+            # asyncio holds no pipes of this process, so this is its exit alone
+            try:
+                await asyncio.wait_for(asyncio.shield(proc.wait()), timeout)
+            except asyncio.TimeoutError:
+                logger.error('%s - timed out after %s seconds', name, timeout)
+                if piped:
+                    await self.loop.run_in_executor(None, log.write,
+                                                    '\n[rain: timed out after {} seconds]\n'.format(timeout))
+                await self.terminate(proc)
+            finally:
+                if exited:
+                    exited()
+
+            if pumped:
+                await pumped
+
+            return proc.returncode
+
+        finally:
+            self.running.discard(proc)
+
+    def start_pump(self, reader, log):
+        """
+        Copy the pipe *reader* into *log* from a thread of its own, so
+        that compressing and writing logs never holds up the loop.
+
+        :return: a future done when the pump is, and a function to
+            call, once, when the command has exited.
+        """
+        done = self.loop.create_future()
+        wake, waker = os.pipe()
+
+        def run():
+            try:
+                self.pump(reader, log, wake, self.drain)
+            except Exception as e:
+                logger.error('%s - log failed: %s', log.filename, e)
+            finally:
+                os.close(reader)
+                os.close(wake)
+                self.loop.call_soon_threadsafe(done.set_result, None)
+
+        def exited():
+            try:
+                os.write(waker, b'x')
+            except BrokenPipeError:
+                pass # the pump has already finished
+            finally:
+                os.close(waker)
+
+        thread = threading.Thread(target=run, name='pump')
+        thread.daemon = True
+        thread.start()
+        return done, exited
+
+    @staticmethod
+    def pump(reader, log, wake, drain):
+        """
+        Copy *reader* into *log* until it closes or, once *wake* is
+        readable, until nothing more comes for *drain* seconds, so that
+        a background process left holding the pipe, like a compiler
+        server, doesn't keep the build running.
+        """
+        deadline = None
+        while True:
+            if deadline is None:
+                readable, _, _ = select.select([reader, wake], [], [])
+                if wake in readable:
+                    deadline = time.monotonic() + drain
+            else:
+                readable, _, _ = select.select([reader], [], [], max(0, deadline - time.monotonic()))
+                if not readable:
+                    return
+
+            if reader in readable:
+                chunk = os.read(reader, chunk_size)
+                if not chunk:
+                    return
+                log.write(chunk)
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+
+    @staticmethod
+    def signal_group(proc, signum):
+        try:
+            os.killpg(proc.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    async def terminate(self, proc):
+        """SIGTERM the process group of *proc*, then SIGKILL whatever is left"""
+        self.signal_group(proc, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.shield(proc.wait()), self.grace)
+        except asyncio.TimeoutError:
+            logger.warning('%s - still running %s seconds after SIGTERM, killing', proc.pid, self.grace)
+
+        self.signal_group(proc, signal.SIGKILL)
+        await proc.wait()
+
+    async def terminate_all(self):
+        await asyncio.gather(*[self.terminate(proc) for proc in list(self.running)])
+
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+def supervisor():
+    """the supervisor shared by everything in this process"""
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = Supervisor()
+        return _supervisor
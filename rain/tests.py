@@ -9,9 +9,38 @@
 tests.
 '''
 
+import argparse
+import errno
+import glob
+import gzip
+import json
+import os
+import resource
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
 import nose
 
 import rain
+import rain.archive
+import rain.bench
+import rain.cache
+import rain.daemon
+import rain.index
+import rain.logindex
+import rain.logpipe
+import rain.options
+import rain.stages
+import rain.supervise
+import rain.trigger
+import rain.main
 
 verbose_logging = False
 if verbose_logging:
@@ -32,3 +61,1361 @@ class testLocation:
     def testNamed(self):
         name = 'named'
         nose.tools.assert_equal(name, rain.Location(name=name).name)
+
+
+class testLocationPool:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def wait_for_spares(self, location, count):
+        for i in range(100):
+            with location.condition:
+                if len(location.ready) >= count:
+                    return
+            time.sleep(0.01)
+
+        raise AssertionError('spares never appeared')
+
+    def testSingle(self):
+        location = rain.Location(self.tmpdir)
+        workspace = location.next_workspace()
+        nose.tools.assert_true(os.path.isdir(workspace.name))
+        nose.tools.assert_is(workspace, location.workspace)
+        nose.tools.assert_raises(rain.AllocationError, location.next_workspace)
+
+        location.remove_workspace(workspace)
+        nose.tools.assert_false(os.path.exists(workspace.name))
+        nose.tools.assert_raises(rain.AllocationError, location.remove_workspace, workspace)
+
+    def testSpares(self):
+        location = rain.Location(self.tmpdir, size=3, spares=2)
+        first = location.next_workspace()
+        self.wait_for_spares(location, 2)
+
+        name = os.path.join(self.tmpdir, 'named')
+        second = location.next_workspace(name=name)
+        nose.tools.assert_equal(name, second.name)
+        nose.tools.assert_true(os.path.isdir(name))
+
+        # only one more may be allocated, so only one spare is kept
+        third = location.next_workspace()
+        nose.tools.assert_raises(rain.AllocationError, location.next_workspace)
+        nose.tools.assert_equal(0, location._wanted())
+
+        with open(os.path.join(first.name, 'junk'), 'w') as junk:
+            junk.write('junk\n')
+        location.remove_workspace(first)
+        self.wait_for_spares(location, 1)
+        nose.tools.assert_equal([], os.listdir(location.ready[0].name))
+
+        location.close()
+        nose.tools.assert_equal(sorted(['named', os.path.basename(third.name)]), sorted(os.listdir(self.tmpdir)))
+
+    def testBackoff(self):
+        location = rain.Location(self.tmpdir, size=3, spares=2)
+        location.backoff = 0.05
+        attempts = []
+
+        def full():
+            attempts.append(time.time())
+            raise OSError(errno.ENOSPC, 'No space left on device')
+
+        location._create = full
+        location._start()
+        time.sleep(0.5)
+        start = time.time()
+        location.close()
+
+        nose.tools.assert_true(2 <= len(attempts) < 10)
+        nose.tools.assert_true(time.time() - start < 1)
+
+
+def logger():
+    import logging
+    return logging.getLogger()
+
+trivial_mk = """#!/bin/sh
+echo $1
+"""
+
+class fakeLoad:
+    def __init__(self, busy):
+        self.busy = lambda path: busy.get(os.path.basename(path), 0.0)
+
+
+class testScheduler:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.roots = []
+        for name in ['a', 'b']:
+            self.roots.append(os.path.join(self.tmpdir, name))
+            os.mkdir(self.roots[-1])
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testBusy(self):
+        locations = [rain.Location(root, size=None) for root in self.roots]
+        scheduler = rain.Scheduler(locations, load=fakeLoad({'a': 0.9}))
+        nose.tools.assert_is(locations[1], scheduler.pick())
+
+    def testSpread(self):
+        locations = [rain.Location(root, size=1) for root in self.roots]
+        scheduler = rain.Scheduler(locations, load=fakeLoad({}))
+        picked = [scheduler.pick(), scheduler.pick()]
+        nose.tools.assert_equal(set(locations), set(picked))
+        nose.tools.assert_raises(rain.AllocationError, scheduler.pick)
+
+        scheduler.release(picked[0])
+        nose.tools.assert_is(picked[0], scheduler.pick())
+
+    def testFull(self):
+        scheduler = rain.Scheduler([rain.Location(root) for root in self.roots], min_free=2 ** 62)
+        nose.tools.assert_raises(rain.AllocationError, scheduler.pick)
+
+    def testDiskLoad(self):
+        diskstats = os.path.join(self.tmpdir, 'diskstats')
+        def write(ticks):
+            with open(diskstats, 'w') as f:
+                f.write('   8       0 sda 1 2 3 4 5 6 7 8 9 {} 11\n'.format(ticks))
+
+        write(1000)
+        load = rain.DiskLoad(diskstats, interval=0)
+        load.refresh()
+        load.when -= 1.0
+        write(1500)
+        load.refresh()
+        nose.tools.assert_almost_equal(0.5, load.utilization[(8, 0)], places=1)
+
+
+class testMemoryRoot:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.meminfo = os.path.join(self.tmpdir, 'meminfo')
+        self.write_meminfo(8 * 1024 ** 2)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_meminfo(self, kb):
+        with open(self.meminfo, 'w') as f:
+            f.write('MemTotal:       16000000 kB\nMemAvailable:   {} kB\n'.format(kb))
+
+    def testClaim(self):
+        memory = rain.MemoryRoot(self.tmpdir, budget=1000, reserve=1024 ** 3, meminfo=self.meminfo)
+        nose.tools.assert_equal(None, memory.claim('unknown', None))
+        nose.tools.assert_equal(None, memory.claim('toobig', 1001))
+
+        first = memory.claim('first', 600)
+        nose.tools.assert_true(os.path.isdir(first))
+        nose.tools.assert_equal(None, memory.claim('second', 600))
+        memory.release(first)
+        nose.tools.assert_true(memory.claim('second', 600))
+
+    def testPressure(self):
+        memory = rain.MemoryRoot(self.tmpdir, budget=1000, reserve=1024 ** 3, meminfo=self.meminfo)
+        self.write_meminfo(1024 ** 2)
+        nose.tools.assert_equal(None, memory.claim('pressed', 10))
+        nose.tools.assert_equal(1024 ** 3, rain.mem_available(self.meminfo))
+
+    def testAdmission(self):
+        loads = [4.0, 3.0, 1.0]
+        sleeps = []
+        admission = rain.Admission(max_load=2, min_memory=512 * 1024 ** 2, min_free=1, paths=[self.tmpdir],
+                                   backoff=1, max_backoff=3, meminfo=self.meminfo,
+                                   loadavg=lambda: (loads.pop(0), 0, 0), sleep=sleeps.append)
+        admission.wait()
+        nose.tools.assert_equal([1, 2], sleeps)
+
+        self.write_meminfo(1024)
+        loads[:] = [1.0]
+        nose.tools.assert_equal(1, len(admission.reasons()))
+
+        admission.min_free = 1024 ** 5
+        loads[:] = [1.0]
+        nose.tools.assert_equal(2, len(admission.reasons()))
+
+
+class testWorkArea:
+    def setup(self):
+        self.savedir = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write(trivial_mk)
+        os.chmod('rain.mk', stat.S_IRWXU)
+
+    def teardown(self):
+        os.chdir(self.savedir)
+        shutil.rmtree(self.tmpdir)
+
+    def testUniqueNames(self):
+        area = rain.main.WorkArea(logger())
+        isodate = rain.main.isodate
+        rain.main.isodate = lambda: 'now'
+        try:
+            names = [area.new_working_directory('rain.mk').name for i in range(3)]
+        finally:
+            rain.main.isodate = isodate
+
+        nose.tools.assert_equal(['now', 'now-1', 'now-2'], names)
+
+    def assertBuilt(self, area, count):
+        dirs = area.raindirs()
+        nose.tools.assert_equal(count, len(dirs))
+        for dir in dirs:
+            with open(os.path.join(dir, '.rain')) as dotrain:
+                nose.tools.assert_equal('built\n', dotrain.read())
+
+    def testJobs(self):
+        area = rain.main.WorkArea(logger())
+        options = argparse.Namespace(count=4, jobs=2, keep=-1)
+        nose.tools.assert_true(rain.main.build_loop(area, options, os.path.abspath('rain.mk')))
+        self.assertBuilt(area, 4)
+
+    def testPipeline(self):
+        area = rain.main.WorkArea(logger())
+        options = argparse.Namespace(count=3, pipeline=1, keep=-1)
+        nose.tools.assert_true(rain.main.pipeline_loop(area, options, os.path.abspath('rain.mk')))
+        self.assertBuilt(area, 3)
+        nose.tools.assert_false(area.reserved)
+
+    def testSeed(self):
+        area = rain.main.WorkArea(logger(), seed=True)
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+        first = area.last_built()
+        with open(os.path.join(first, 'output'), 'w') as output:
+            output.write('output\n')
+
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+        second = area.last_built()
+        nose.tools.assert_not_equal(first, second)
+        nose.tools.assert_true(os.path.exists(os.path.join(second, 'output')))
+        nose.tools.assert_equal(1, len(glob.glob(os.path.join(second, 'Log-*'))))
+        nose.tools.assert_false(area.reserved)
+
+    def testIndex(self):
+        area = rain.main.WorkArea(logger())
+        options = argparse.Namespace(count=2, jobs=1, keep=-1)
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+
+        rows = area.index.rows()
+        nose.tools.assert_equal(2, len(rows))
+        for row in rows:
+            nose.tools.assert_equal('built', row['state'])
+            nose.tools.assert_equal(0, row['exitcode'])
+            nose.tools.assert_true(row['started'] <= row['ended'])
+            nose.tools.assert_true(row['size'] > 0)
+
+        area.keep(1)
+        nose.tools.assert_equal([rows[-1]['name']], area.raindirs())
+
+    def testReindex(self):
+        os.mkdir('old')
+        with open(os.path.join('old', '.rain'), 'w') as dotrain:
+            dotrain.write('built\n')
+
+        area = rain.main.WorkArea(logger())
+        nose.tools.assert_equal(['old'], area.raindirs())
+        nose.tools.assert_equal('old', area.last_built())
+
+        shutil.rmtree('old')
+        area.reindex()
+        nose.tools.assert_equal([], area.raindirs())
+
+    def testCache(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n[ "$1" = build ] && echo built > output\nexit 0\n')
+
+        area = rain.main.WorkArea(logger(), cache='link')
+        options = argparse.Namespace(count=2, jobs=1, keep=-1)
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+
+        first, second = area.index.rows()
+        nose.tools.assert_equal('built', first['state'])
+        nose.tools.assert_equal('cached', second['state'])
+        nose.tools.assert_equal(first['fingerprint'], second['fingerprint'])
+        nose.tools.assert_equal(os.stat(os.path.join(first['name'], 'output')).st_ino,
+                                os.stat(os.path.join(second['name'], 'output')).st_ino)
+
+        with open('rain.mk', 'a') as mkfile:
+            mkfile.write('# changed\n')
+
+        rain.main.build_loop(area, argparse.Namespace(count=1, jobs=1, keep=-1), os.path.abspath('rain.mk'))
+        nose.tools.assert_equal('built', area.index.rows()[-1]['state'])
+
+    def testFailureTail(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\necho doing $1\n[ "$1" = build ] && echo oops && exit 2\nexit 0\n')
+
+        area = rain.main.WorkArea(logger(), logconfig={'compress': 'gzip'})
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        nose.tools.assert_raises(rain.main.BuildException,
+                                 rain.main.build_loop, area, options, os.path.abspath('rain.mk'))
+
+        dir, = area.raindirs()
+        logname, = glob.glob(os.path.join(dir, 'Log-*.gz'))
+        with gzip.open(logname) as log:
+            nose.tools.assert_equal(b'doing populate\ndoing build\noops\n', log.read())
+
+        with open(logname[:-len('.gz')] + '.tail', 'rb') as tail:
+            nose.tools.assert_equal(b'doing populate\ndoing build\noops\n', tail.read())
+
+    def testMetrics(self):
+        area = rain.main.WorkArea(logger(), prometheus='rain.prom')
+        options = argparse.Namespace(count=2, jobs=1, keep=1)
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+
+        dir = area.last_built()
+        with open(os.path.join(dir, '.rain.json')) as f:
+            record = json.load(f)
+
+        nose.tools.assert_equal('built', record['state'])
+        nose.tools.assert_equal(['build', 'clear', 'keep', 'populate'], sorted(record['phases']))
+        for phase in record['phases'].values():
+            nose.tools.assert_true(phase['wall'] >= 0)
+
+        with open('rain.prom') as f:
+            prom = f.read()
+        nose.tools.assert_in('rain_phase_wall_seconds{phase="build"}', prom)
+        nose.tools.assert_in('rain_last_build_success 1\n', prom)
+
+    def testSpares(self):
+        location = rain.Location('.', size=2, spares=1, prefix='.rain-spare')
+        area = rain.main.WorkArea(logger(), location=location)
+        options = argparse.Namespace(count=3, jobs=1, keep=-1)
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+        location.close()
+
+        self.assertBuilt(area, 3)
+        nose.tools.assert_false(location.workspaces)
+        nose.tools.assert_equal([], glob.glob('.rain-spare-*'))
+
+    def testRoots(self):
+        roots = ['a', 'b']
+        for root in roots:
+            os.mkdir(root)
+
+        scheduler = rain.Scheduler([rain.Location(root, size=None) for root in roots], load=fakeLoad({}))
+        area = rain.main.WorkArea(logger(), scheduler=scheduler, roots=roots)
+        options = argparse.Namespace(count=4, jobs=2, keep=-1)
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+
+        self.assertBuilt(area, 4)
+        nose.tools.assert_equal(set(roots), set(os.path.dirname(dir) for dir in area.raindirs()))
+        nose.tools.assert_equal(area.raindirs(), area.scan())
+        nose.tools.assert_false(scheduler.assigned)
+
+        area.keep(1)
+        nose.tools.assert_equal(1, len(area.raindirs()))
+
+    def memoryArea(self, spill):
+        os.mkdir('memory')
+        meminfo = os.path.abspath('meminfo')
+        with open(meminfo, 'w') as f:
+            f.write('MemAvailable:   {} kB\n'.format(8 * 1024 ** 2))
+
+        memory = rain.MemoryRoot('memory', budget=1024 ** 3, reserve=0, meminfo=meminfo)
+        return rain.main.WorkArea(logger(), memory=memory, spill=spill)
+
+    def testMemory(self):
+        area = self.memoryArea('move')
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+
+        self.assertBuilt(area, 2)
+        for dir in area.raindirs():
+            nose.tools.assert_false(os.path.islink(dir))
+        nose.tools.assert_equal(1, len(glob.glob(os.path.join(area.raindirs()[-1], 'Log-*'))))
+        nose.tools.assert_equal([], os.listdir('memory'))
+        nose.tools.assert_false(area.memory.claimed)
+
+    def testMemoryArchive(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n[ "$1" = build ] && echo built > output\nexit 0\n')
+
+        area = self.memoryArea('archive')
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+
+        self.assertBuilt(area, 2)
+        dir = area.raindirs()[-1]
+        nose.tools.assert_false(os.path.exists(os.path.join(dir, 'output')))
+        with tarfile.open(os.path.join(dir, 'tree.tar.gz')) as tar:
+            nose.tools.assert_in('./output', tar.getnames())
+
+    def testKeepMissing(self):
+        area = rain.main.WorkArea(logger())
+        rain.main.build_loop(area, argparse.Namespace(count=3, jobs=1, keep=-1), os.path.abspath('rain.mk'))
+        gone = area.raindirs()[1]
+        shutil.rmtree(gone)
+
+        area.keep(1)
+        nose.tools.assert_equal(1, len(area.raindirs()))
+        nose.tools.assert_equal(None, area.index.get(gone))
+        area.keep(1)
+
+    def testQueryReadOnly(self):
+        os.mkdir('old')
+        with open(os.path.join('old', '.rain'), 'w') as dotrain:
+            dotrain.write('built\n')
+
+        area = rain.main.WorkArea(logger(), readonly=True)
+        nose.tools.assert_equal('old', rain.main.answer(area, 'ls'))
+        nose.tools.assert_equal(None, area.index.get('old')['size'])
+        nose.tools.assert_false(os.path.exists('.rain.db'))
+
+    def testOneShotReaper(self):
+        os.mkdir('old')
+        with open(os.path.join('old', '.rain'), 'w') as dotrain:
+            dotrain.write('built\n')
+
+        argv = sys.argv
+        try:
+            sys.argv = ['rain', 'ls']
+            rain.main.main()
+            nose.tools.assert_false(os.path.exists('.rain-trash'))
+
+            # rm moves the build to the trash and leaves it for the next build to reap
+            sys.argv = ['rain', 'rm']
+            rain.main.main()
+        finally:
+            sys.argv = argv
+
+        nose.tools.assert_false(os.path.exists('old'))
+        nose.tools.assert_equal(1, len(os.listdir('.rain-trash')))
+
+    def testRetention(self):
+        area = rain.main.WorkArea(logger())
+        now = time.time()
+        # oldest first: failed, good, failed, failed, good, failed, failed
+        for i, (state, exitcode) in enumerate([('populated', 2), ('built', 0), ('populated', 2), ('incomplete', 1),
+                                               ('cached', 0), ('populated', 2), ('incomplete', 1)]):
+            area.index.record('b{}'.format(i), state=state, exitcode=exitcode, ended=now - (7 - i) * 3600,
+                              size=100)
+        rows = area.index.rows()
+        names = [row['name'] for row in rows]
+
+        nose.tools.assert_equal(names[:5], area.doomed(rows, 2, now))
+
+        area.keep_good = True
+        nose.tools.assert_equal(names[:4], area.doomed(rows, 1, now))
+
+        area.keep_good = False
+        area.max_age = 4.5 * 3600
+        nose.tools.assert_equal(names[:3], area.doomed(rows, -1, now))
+
+        area.max_age = None
+        area.budget = 250
+        nose.tools.assert_equal(names[:5], area.doomed(rows, -1, now))
+
+        area.keep_good = True
+        nose.tools.assert_equal(names[:4] + names[6:], area.doomed(rows, -1, now))
+
+        # with nothing good, keeping good builds keeps no failures either
+        failures = [row for row in rows if row['exitcode']]
+        nose.tools.assert_equal(set(), area.protected(failures))
+        nose.tools.assert_equal([row['name'] for row in failures[:-1]], area.doomed(failures, 1, now))
+
+    def testTimeout(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n[ "$1" = build ] && sleep 60\nexit 0\n')
+
+        area = rain.main.WorkArea(logger(), timeouts={'build': 0.5})
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        nose.tools.assert_raises(rain.main.BuildException,
+                                 rain.main.build_loop, area, options, os.path.abspath('rain.mk'))
+        nose.tools.assert_equal(-15, area.index.rows()[0]['exitcode'])
+
+    def testResume(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n'
+                         'case "$1" in\n'
+                         'populate) echo populated >> count ;;\n'
+                         'build) echo built > output ;;\n'
+                         'esac\n'
+                         'exit 0\n')
+
+        area = rain.main.WorkArea(logger())
+        wd = area.new_working_directory(os.path.abspath('rain.mk'))
+        wd.start()
+        with wd.logfile() as logfile:
+            wd.populate(logfile)
+        area.release(wd)
+
+        nose.tools.assert_equal([wd.name], area.resumable())
+        nose.tools.assert_equal([], glob.glob(os.path.join(wd.name, '.rain.new')))
+
+        options = argparse.Namespace(jobs=2)
+        nose.tools.assert_true(rain.main.resume_loop(area, options, os.path.abspath('rain.mk')))
+        nose.tools.assert_equal('built', area.read_state(wd.name))
+        nose.tools.assert_equal(0, area.index.get(wd.name)['exitcode'])
+        with open(os.path.join(wd.name, 'count')) as f:
+            nose.tools.assert_equal('populated\n', f.read())
+        nose.tools.assert_equal(2, len(glob.glob(os.path.join(wd.name, 'Log-*'))))
+        nose.tools.assert_equal([], area.resumable())
+
+    def testBisect(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n'
+                         'case "$1" in\n'
+                         'revisions) seq $(($2 + 1)) $3 ;;\n'
+                         'populate) [ "$RAIN_REVISION" != 7 ] && echo $RAIN_REVISION > revision ;;\n'
+                         'build) [ $(cat revision) -lt 13 ] ;;\n'
+                         'esac\n')
+
+        area = rain.main.WorkArea(logger())
+        options = argparse.Namespace(jobs=3)
+        nose.tools.assert_equal('13', rain.main.bisect_loop(area, options, os.path.abspath('rain.mk'), '0', '40'))
+
+        rows = area.index.rows()
+        nose.tools.assert_true(len(rows) < 12)
+        for row in rows:
+            with open(os.path.join(row['name'], 'revision')) as f:
+                nose.tools.assert_equal(row['revision'] + '\n', f.read())
+
+        marked = dict((row['bisect'], row['revision']) for row in rows if row['bisect'])
+        nose.tools.assert_equal({'first bad': '13', 'last good': '12'}, marked)
+
+        # builds of other revisions seed, cache and protect nothing
+        area.index.record(rows[0]['name'], fingerprint='f')
+        nose.tools.assert_equal(None, area.last_built())
+        nose.tools.assert_equal(None, area.index.matching('f'))
+        area.keep_good = True
+        nose.tools.assert_equal(set(), area.protected(rows))
+
+    def testBisectSkip(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n'
+                         'case "$1" in\n'
+                         'revisions) seq $(($2 + 1)) $3 ;;\n'
+                         'populate) [ "$RAIN_REVISION" != 3 ] && echo $RAIN_REVISION > revision ;;\n'
+                         'build) [ $(cat revision) -lt 3 ] ;;\n'
+                         'esac\n')
+
+        area = rain.main.WorkArea(logger())
+        options = argparse.Namespace(jobs=1)
+        nose.tools.assert_equal('4', rain.main.bisect_loop(area, options, os.path.abspath('rain.mk'), '0', '8'))
+
+    def testArchive(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n[ "$1" = build ] || exit 0\n'
+                         'echo built > output\nmkdir dist\necho wheel > dist/pkg.whl\n')
+
+        area = rain.main.WorkArea(logger(), archive_after=1, archive_globs=['dist/*'])
+        options = argparse.Namespace(count=3, jobs=1, keep=-1)
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+        area.keep(-1)
+
+        rows = area.index.rows()
+        nose.tools.assert_equal(3, len(rows))
+        for row in rows[:2]:
+            nose.tools.assert_false(os.path.exists(row['name']))
+            nose.tools.assert_equal(os.path.getsize(row['archive']), row['size'])
+        nose.tools.assert_equal(None, rows[2]['archive'])
+        nose.tools.assert_equal(rows[2]['name'], area.last_built())
+
+        area.reindex()
+        nose.tools.assert_equal([(row['name'], row['state'], row['archive']) for row in rows],
+                                [(row['name'], row['state'], row['archive']) for row in area.index.rows()])
+
+        first = rows[0]['name']
+        area.extract(first)
+        nose.tools.assert_false(os.path.exists(rows[0]['archive']))
+        nose.tools.assert_equal('built', area.read_state(first))
+        nose.tools.assert_true(os.path.exists(os.path.join(first, 'dist', 'pkg.whl')))
+        nose.tools.assert_false(os.path.exists(os.path.join(first, 'output')))
+        nose.tools.assert_equal(1, len(glob.glob(os.path.join(first, 'Log-*'))))
+
+        area.keep(1)
+        nose.tools.assert_equal([rows[2]['name']], area.raindirs())
+        nose.tools.assert_equal([], glob.glob('*.tar.*'))
+
+    def testArchivePartial(self):
+        # nothing appears under an archive's own name until it is complete
+        os.mkdir('build')
+        with open(os.path.join('build', '.rain'), 'w') as f:
+            f.write('built\n')
+
+        seen = []
+        add = tarfile.TarFile.add
+
+        def spy(tar, *args, **kwargs):
+            seen.extend(name for name in ['build' + suffix for suffix in rain.archive.suffixes]
+                        if os.path.exists(name))
+            return add(tar, *args, **kwargs)
+
+        tarfile.TarFile.add = spy
+        try:
+            filename = rain.archive.archive('build')
+        finally:
+            tarfile.TarFile.add = add
+
+        nose.tools.assert_equal([], seen)
+        nose.tools.assert_equal(b'built\n', rain.archive.read_member(filename, '.rain'))
+        nose.tools.assert_equal([filename], glob.glob('build.tar.*'))
+
+    def testArchiveUnreadable(self):
+        # a .tar.zst with neither the zstd command nor zstandard to read it
+        with open('build.tar.zst', 'wb') as f:
+            f.write(b'not really')
+
+        which = shutil.which
+        zstandard = rain.archive.zstandard
+        shutil.which = lambda name: None
+        rain.archive.zstandard = None
+        try:
+            nose.tools.assert_raises(IOError, rain.archive.read_member, 'build.tar.zst', '.rain')
+            nose.tools.assert_raises(IOError, rain.archive.extract, 'build.tar.zst', 'build')
+            nose.tools.assert_false(os.path.exists('build'))
+
+            area = rain.main.WorkArea(logger())
+        finally:
+            shutil.which = which
+            rain.archive.zstandard = zstandard
+
+        row = area.index.get('build')
+        nose.tools.assert_equal((None, 'build.tar.zst'), (row['state'], row['archive']))
+
+    def testStages(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n'
+                         'wait_for() { for i in $(seq 100); do [ -f $1 ] && return 0; sleep 0.05; done; return 1; }\n'
+                         'case "$1" in\n'
+                         'stages) printf "compile:\\nunit: compile\\nlint: compile\\nbroken: compile\\n'
+                         'package: unit lint broken\\n" ;;\n'
+                         'unit) touch unit; wait_for lint ;;\n'
+                         'lint) touch lint; wait_for unit ;;\n'
+                         'broken) echo oops; exit 3 ;;\n'
+                         'esac\n'
+                         'exit 0\n')
+
+        area = rain.main.WorkArea(logger(), stages=True)
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        nose.tools.assert_raises(rain.main.BuildException,
+                                 rain.main.build_loop, area, options, os.path.abspath('rain.mk'))
+
+        row, = area.index.rows()
+        nose.tools.assert_equal(3, row['exitcode'])
+        states = dict((stage['stage'], stage['state']) for stage in area.index.stages(row['name']))
+        nose.tools.assert_equal({'compile': 'done', 'unit': 'done', 'lint': 'done', 'broken': 'failed',
+                                 'package': 'skipped'}, states)
+        with open(os.path.join(row['name'], '.rain.stages')) as f:
+            nose.tools.assert_equal('compile done\nunit done\nlint done\nbroken failed\npackage skipped\n', f.read())
+        nose.tools.assert_equal(1, len(glob.glob(os.path.join(row['name'], 'Log-*-broken.tail'))))
+
+        # stages are only asked for with stages
+        area = rain.main.WorkArea(logger())
+        nose.tools.assert_true(rain.main.build_loop(area, options, os.path.abspath('rain.mk')))
+        nose.tools.assert_equal([], area.index.stages(area.index.rows()[-1]['name']))
+
+    def testStageTimeout(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n'
+                         'case "$1" in\n'
+                         'stages) printf "compile:\\ntest/2: compile\\n" ;;\n'
+                         'compile) sleep $(cat ../compile) ;;\n'
+                         'test) sleep 60 ;;\n'
+                         'esac\n'
+                         'exit 0\n')
+        with open('compile', 'w') as f:
+            f.write('60\n')
+
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        area = rain.main.WorkArea(logger(), timeouts={'build': 0.5}, stages=True)
+        nose.tools.assert_raises(rain.main.BuildException,
+                                 rain.main.build_loop, area, options, os.path.abspath('rain.mk'))
+        nose.tools.assert_equal(-15, area.index.rows()[-1]['exitcode'])
+
+        # a stage's own timeout overrides build's, and shards get it too
+        with open('compile', 'w') as f:
+            f.write('1\n')
+        area.timeouts = {'build': 0.5, 'compile': 30, 'test': 0.5}
+        nose.tools.assert_raises(rain.main.BuildException,
+                                 rain.main.build_loop, area, options, os.path.abspath('rain.mk'))
+        row = area.index.rows()[-1]
+        states = dict((stage['stage'], (stage['state'], stage['exitcode'])) for stage in area.index.stages(row['name']))
+        nose.tools.assert_equal({'compile': ('done', 0), 'test': ('failed', -15), 'test/0': ('failed', -15),
+                                 'test/1': ('failed', -15)}, states)
+
+        nose.tools.assert_equal(('unit', 90.0), rain.options.stage_timeout('unit=90'))
+        nose.tools.assert_raises(argparse.ArgumentTypeError, rain.options.stage_timeout, 'unit')
+
+    def testStagesFallback(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n'
+                         'case "$1" in\n'
+                         'populate|build) echo $1 >> done ;;\n'
+                         '*) echo "usage: rain.mk populate|build" ;;\n'
+                         'esac\n'
+                         'exit 0\n')
+
+        area = rain.main.WorkArea(logger(), stages=True)
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        nose.tools.assert_true(rain.main.build_loop(area, options, os.path.abspath('rain.mk')))
+
+        row, = area.index.rows()
+        nose.tools.assert_equal('built', row['state'])
+        with open(os.path.join(row['name'], 'done')) as f:
+            nose.tools.assert_equal('populate\nbuild\n', f.read())
+
+    def testStageCache(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n'
+                         'case "$1" in\n'
+                         'stages) printf "configure:\\ncompile: configure\\ntest: compile\\n" ;;\n'
+                         'configure) echo configured > configured ;;\n'
+                         'compile) cat configured > compiled; echo >> ../compiles ;;\n'
+                         'test) [ -f compiled ] && [ -f ../passing ] || exit 1 ;;\n'
+                         'esac\n'
+                         'exit 0\n')
+
+        buildscript = os.path.abspath('rain.mk')
+        for cache in ['link', 'skip']:
+            os.mkdir(cache)
+            os.chdir(cache)
+
+            area = rain.main.WorkArea(logger(), cache=cache, stages=True)
+            options = argparse.Namespace(count=1, jobs=1, keep=-1)
+            nose.tools.assert_raises(rain.main.BuildException, rain.main.build_loop, area, options, buildscript)
+
+            open('passing', 'w').close()
+            nose.tools.assert_true(rain.main.build_loop(area, options, buildscript))
+
+            first, second = area.index.rows()
+            nose.tools.assert_equal('built', second['state'])
+            states = [stage['state'] for stage in area.index.stages(second['name'])]
+            with open('compiles') as f:
+                compiles = len(f.readlines())
+
+            if cache == 'link':
+                nose.tools.assert_equal(['cached', 'cached', 'done'], states)
+                nose.tools.assert_equal(1, compiles)
+                nose.tools.assert_equal(os.stat(os.path.join(first['name'], 'compiled')).st_ino,
+                                        os.stat(os.path.join(second['name'], 'compiled')).st_ino)
+            else:
+                # skipping would leave test without the outputs it needs
+                nose.tools.assert_equal(['done', 'done', 'done'], states)
+                nose.tools.assert_equal(2, compiles)
+
+            area.index.close()
+            os.chdir(self.tmpdir)
+
+    def testShards(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n'
+                         'case "$1" in\n'
+                         'stages) printf "compile:\\ntest/3: compile\\n" ;;\n'
+                         'test) touch shard-$RAIN_SHARD_INDEX\n'
+                         '      for i in $(seq 100); do [ $(ls shard-* | wc -l) = $RAIN_SHARD_COUNT ] && break;'
+                         ' sleep 0.05; done\n'
+                         '      echo shard $RAIN_SHARD_INDEX of $RAIN_SHARD_COUNT\n'
+                         '      [ -f ../fail ] && [ $RAIN_SHARD_INDEX = 1 ] && exit 5 ;;\n'
+                         'esac\n'
+                         'exit 0\n')
+
+        area = rain.main.WorkArea(logger(), logconfig={'compress': 'gzip'}, shard_target=60, stages=True)
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        nose.tools.assert_true(rain.main.build_loop(area, options, os.path.abspath('rain.mk')))
+
+        row, = area.index.rows()
+        nose.tools.assert_equal(3, len(glob.glob(os.path.join(row['name'], 'shard-*'))))
+        logname, = glob.glob(os.path.join(row['name'], 'Log-*-test.gz'))
+        with gzip.open(logname) as log:
+            text = log.read().decode('utf-8')
+        nose.tools.assert_in('shard 0 of 3\n[rain: shard 1/3 exited 0]\nshard 1 of 3\n', text)
+        nose.tools.assert_equal(3, len(area.index.shard_durations('test')))
+
+        # the last run's shards were quick so this one needs only one
+        open('fail', 'w').close()
+        nose.tools.assert_true(rain.main.build_loop(area, options, os.path.abspath('rain.mk')))
+        nose.tools.assert_equal(1, len(glob.glob(os.path.join(area.index.rows()[-1]['name'], 'shard-*'))))
+
+        area.shard_target = None
+        nose.tools.assert_raises(rain.main.BuildException,
+                                 rain.main.build_loop, area, options, os.path.abspath('rain.mk'))
+        row = area.index.rows()[-1]
+        nose.tools.assert_equal(5, row['exitcode'])
+        states = dict((stage['stage'], stage['state']) for stage in area.index.stages(row['name']))
+        nose.tools.assert_equal({'compile': 'done', 'test': 'failed', 'test/0': 'done', 'test/1': 'failed',
+                                 'test/2': 'done'}, states)
+
+    def testMatrix(self):
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\n'
+                         'case "$1" in\n'
+                         'populate) echo >> ../populates; echo source > source ;;\n'
+                         'build) touch ../started-$CC-$MODE\n'
+                         '       for i in $(seq 100); do [ $(ls ../started-* | wc -l) = 4 ] && break; sleep 0.05; done\n'
+                         '       echo $CC $MODE > output\n'
+                         '       [ -f ../fail ] && [ $CC = clang ] && [ $MODE = release ] && exit 4 ;;\n'
+                         'esac\n'
+                         'exit 0\n')
+
+        matrix = rain.options.variants(['CC=gcc,clang', 'MODE=debug,release'])
+        nose.tools.assert_equal(4, len(matrix))
+        nose.tools.assert_raises(ValueError, rain.options.variants, ['CC'])
+
+        area = rain.main.WorkArea(logger(), cache='link')
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        nose.tools.assert_true(rain.main.matrix_loop(area, options, os.path.abspath('rain.mk'), matrix))
+
+        base, *rows = area.index.rows()
+        nose.tools.assert_equal('populated', base['state'])
+        nose.tools.assert_equal(None, base['variant'])
+        nose.tools.assert_equal(['built'] * 4, [row['state'] for row in rows])
+        nose.tools.assert_equal(4, len(set(row['fingerprint'] for row in rows)))
+        with open('populates') as f:
+            nose.tools.assert_equal(1, len(f.readlines()))
+        for row in rows:
+            with open(os.path.join(row['name'], 'output')) as f:
+                nose.tools.assert_equal(row['variant'].replace('CC=', '').replace('MODE=', '') + '\n', f.read())
+            nose.tools.assert_true(os.path.exists(os.path.join(row['name'], 'source')))
+
+        # the same tree again is cached variant by variant
+        rain.main.matrix_loop(area, options, os.path.abspath('rain.mk'), matrix)
+        nose.tools.assert_equal(['cached'] * 4, [row['state'] for row in area.index.rows()[6:]])
+
+        area = rain.main.WorkArea(logger())
+        open('fail', 'w').close()
+        nose.tools.assert_raises(rain.main.BuildException, rain.main.matrix_loop,
+                                 area, options, os.path.abspath('rain.mk'), matrix)
+        rows = area.index.rows()[-4:]
+        nose.tools.assert_equal({'CC=gcc MODE=debug': 0, 'CC=gcc MODE=release': 0, 'CC=clang MODE=debug': 0,
+                                 'CC=clang MODE=release': 4}, dict((row['variant'], row['exitcode']) for row in rows))
+
+    def testMatrixAllocation(self):
+        # too small for the populated tree and both variants at once
+        location = rain.Location('.', size=2)
+        area = rain.main.WorkArea(logger(), location=location)
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        nose.tools.assert_raises(rain.AllocationError, rain.main.matrix_loop, area, options,
+                                 os.path.abspath('rain.mk'), rain.options.variants(['CC=gcc,clang']))
+
+        nose.tools.assert_equal(['populated'], [row['state'] for row in area.index.rows()])
+        nose.tools.assert_false(location.workspaces)
+        nose.tools.assert_false(area.reserved)
+        nose.tools.assert_raises(argparse.ArgumentTypeError, rain.options.matrix_axis, 'CC=')
+
+    def testSharedCache(self):
+        with open('rain.mk', 'w') as mkfile:
+            # logs as ccache does, a line per compilation
+            mkfile.write('#!/bin/sh\n'
+                         '[ "$1" = build ] || exit 0\n'
+                         'for object in a b; do\n'
+                         '  echo "# $object.c" >> "$CCACHE_STATSLOG"\n'
+                         '  if [ -e "$CCACHE_DIR/$object" ]; then echo direct_cache_hit >> "$CCACHE_STATSLOG"; '
+                         'else touch "$CCACHE_DIR/$object"; echo cache_miss >> "$CCACHE_STATSLOG"; fi\n'
+                         'done\n'
+                         'rm -f "$CCACHE_DIR/b"\n')
+
+        shared_cache = rain.cache.SharedCache('cache', 1024 ** 2, logger())
+        area = rain.main.WorkArea(logger(), shared_cache=shared_cache)
+        options = argparse.Namespace(count=1, jobs=1, keep=-1)
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+
+        first, second, third = area.index.rows()
+        nose.tools.assert_equal((0, 2), (first['cache_hits'], first['cache_misses']))
+        nose.tools.assert_equal((1, 1), (second['cache_hits'], second['cache_misses']))
+        nose.tools.assert_equal((1, 1), (third['cache_hits'], third['cache_misses']))
+
+        with open('rain.mk', 'w') as mkfile:
+            mkfile.write('#!/bin/sh\nexit 0\n')
+        rain.main.build_loop(area, options, os.path.abspath('rain.mk'))
+        nose.tools.assert_equal((None, None), (area.index.rows()[-1]['cache_hits'],
+                                               area.index.rows()[-1]['cache_misses']))
+
+
+class testSupervisor:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.supervisor = rain.supervise.Supervisor(grace=1)
+
+    def teardown(self):
+        self.supervisor.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().split()[2] != 'Z'
+
+    def testOutput(self):
+        log = rain.logpipe.LogPipe(os.path.join(self.tmpdir, 'Log'))
+        with log:
+            nose.tools.assert_equal(3, self.supervisor.call(['sh', '-c', 'echo hello; exit 3'], log))
+        with open(log.filename, 'rb') as f:
+            nose.tools.assert_equal(b'hello\n', f.read())
+
+    def testTimeout(self):
+        log = rain.logpipe.LogPipe(os.path.join(self.tmpdir, 'Log'))
+        with log:
+            retval = self.supervisor.call(['sh', '-c', 'sleep 60 & echo $! > pid; wait'], log, cwd=self.tmpdir,
+                                          timeout=0.5)
+        nose.tools.assert_equal(-15, retval)
+
+        with open(os.path.join(self.tmpdir, 'pid')) as f:
+            grandchild = int(f.read())
+        time.sleep(0.1)
+        nose.tools.assert_false(self.alive(grandchild))
+
+    def testLingeringPipe(self):
+        # a background process holding the log open neither times out nor holds up the build
+        log = rain.logpipe.LogPipe(os.path.join(self.tmpdir, 'Log'))
+        start = time.time()
+        with log:
+            retval = self.supervisor.call(['sh', '-c', '(sleep 5 &); echo started'], log, timeout=1)
+        nose.tools.assert_equal(0, retval)
+        nose.tools.assert_true(time.time() - start < 2)
+        with open(log.filename, 'rb') as f:
+            nose.tools.assert_equal(b'started\n', f.read())
+
+    def testLimits(self):
+        log = rain.logpipe.LogPipe(os.path.join(self.tmpdir, 'Log'))
+        with log:
+            self.supervisor.call(['sh', '-c', 'ulimit -n'], log, limits={resource.RLIMIT_NOFILE: 100})
+        with open(log.filename, 'rb') as f:
+            nose.tools.assert_equal(b'100\n', f.read())
+
+    def testCancel(self):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.supervisor.call(['sh', '-c', 'trap "" TERM; sleep 60 & wait'], open(os.devnull, 'w'))))
+        thread.start()
+        while not self.supervisor.running:
+            time.sleep(0.01)
+
+        start = time.time()
+        self.supervisor.cancel()
+        thread.join()
+        nose.tools.assert_equal([-9], results)
+        nose.tools.assert_true(time.time() - start < 10)
+        nose.tools.assert_equal(-15, self.supervisor.call(['true'], open(os.devnull, 'w')))
+
+
+class testDaemon:
+    def setup(self):
+        self.savedir = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+        self.area = rain.main.WorkArea(logger())
+        for name, state in [('a', 'built'), ('b', 'populated'), ('c', 'built')]:
+            os.mkdir(name)
+            self.area.index.record(name, state=state, exitcode=0 if state == 'built' else None)
+
+        self.server = rain.daemon.Server(lambda action, count=1: rain.main.answer(self.area, action, count),
+                                         logger())
+        self.server.start()
+
+    def teardown(self):
+        self.server.stop()
+        os.chdir(self.savedir)
+        shutil.rmtree(self.tmpdir)
+
+    def testQueries(self):
+        nose.tools.assert_equal({'output': 'a\nb\nc', 'status': 0}, rain.daemon.request('ls'))
+        nose.tools.assert_equal('b\tpopulated\t\nc\tbuilt\t0', rain.daemon.request('status', count=2)['output'])
+        nose.tools.assert_equal(1, rain.daemon.request('bogus')['status'])
+
+        rain.daemon.request('keep', count=1)
+        nose.tools.assert_equal(['c'], self.area.raindirs())
+        nose.tools.assert_false(os.path.exists('a'))
+
+    def testTrigger(self):
+        triggered = threading.Event()
+        thread = threading.Thread(target=lambda: (self.server.wait(), triggered.set()))
+        thread.start()
+        nose.tools.assert_false(triggered.wait(0.1))
+        rain.daemon.request('trigger')
+        thread.join()
+        nose.tools.assert_true(triggered.is_set())
+
+    def testRunning(self):
+        nose.tools.assert_raises(rain.daemon.DaemonRunning, rain.daemon.Server(None, logger()).start)
+
+        self.server.stop()
+        nose.tools.assert_equal(None, rain.daemon.request('ls'))
+
+        # a socket left behind by a daemon which died
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(rain.daemon.socket_name)
+        stale.close()
+        nose.tools.assert_equal(None, rain.daemon.request('ls'))
+        self.server.start()
+        nose.tools.assert_equal('a\nb\nc', rain.daemon.request('ls')['output'])
+
+    def testSettings(self):
+        self.server.stop()
+        self.server.settings = rain.daemon.settings(rain.options.parse(['--keep-days', '7']))
+        self.server.start()
+
+        # options before the action, and ones the daemon needn't share
+        nose.tools.assert_equal(0, rain.daemon.main(['-c', '1', 'status']))
+        nose.tools.assert_equal(0, rain.daemon.main(['--keep', '2', 'ls']))
+        nose.tools.assert_equal(1, rain.daemon.main(['ls', '--root', 'elsewhere']))
+
+        # a keep by other rules is refused rather than done by the daemon's
+        nose.tools.assert_equal(1, rain.daemon.main(['keep', '--keep-days', '1']))
+        nose.tools.assert_equal(['a', 'b', 'c'], self.area.raindirs())
+        nose.tools.assert_equal(0, rain.daemon.main(['keep', '--keep-days', '7']))
+        nose.tools.assert_equal(['c'], self.area.raindirs())
+
+        with nose.tools.assert_raises(SystemExit):
+            rain.daemon.main(['ls', '-c', 'x'])
+
+
+class testSharedCache:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testEvict(self):
+        cache = rain.cache.SharedCache(self.tmpdir, 2500, logger())
+        now = time.time()
+        for age, name in enumerate(['newest', 'middle', 'oldest']):
+            path = os.path.join(self.tmpdir, 'downloads', name)
+            with open(path, 'wb') as f:
+                f.write(b'x' * 1000)
+            os.utime(path, (now - 100 * age, now - 100 * age))
+
+        nose.tools.assert_equal(1, cache.evict())
+        nose.tools.assert_equal(['middle', 'newest'], sorted(os.listdir(os.path.join(self.tmpdir, 'downloads'))))
+        nose.tools.assert_equal(0, cache.evict())
+
+    def testBackground(self):
+        cache = rain.cache.SharedCache(self.tmpdir, 500, logger())
+        with open(os.path.join(self.tmpdir, 'pip', 'big'), 'wb') as f:
+            f.write(b'x' * 1000)
+
+        cache.start()
+        cache.poke()
+        for i in range(100):
+            if not os.listdir(os.path.join(self.tmpdir, 'pip')):
+                break
+            time.sleep(0.01)
+        cache.stop()
+
+        nose.tools.assert_equal([], os.listdir(os.path.join(self.tmpdir, 'pip')))
+
+
+class testLogPipe:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'Log')
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testStages(self):
+        log = rain.logpipe.LogPipe(self.filename, compress='gzip')
+        with log:
+            log.write(b'populate\n')
+        with log:
+            log.write(b'build\n')
+
+        nose.tools.assert_equal(self.filename + '.gz', log.filename)
+        with gzip.open(log.filename) as f:
+            nose.tools.assert_equal(b'populate\nbuild\n', f.read())
+
+    def testCap(self):
+        log = rain.logpipe.LogPipe(self.filename, cap=10, tail=4)
+        with log:
+            for i in range(5):
+                log.write(b'0123456789')
+
+        with open(self.filename, 'rb') as f:
+            nose.tools.assert_equal(b'0123456789\n[rain: log truncated at 10 bytes]\n', f.read())
+
+        nose.tools.assert_equal(b'6789', log.tail_bytes())
+        nose.tools.assert_equal(self.filename + '.tail', log.dump_tail())
+
+
+class testLogIndex:
+    def setup(self):
+        self.savedir = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.index = rain.index.BuildIndex()
+        self.logindex = rain.logindex.LogIndex()
+
+    def teardown(self):
+        self.logindex.close()
+        self.index.close()
+        os.chdir(self.savedir)
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, name, text, compress=None):
+        os.mkdir(name)
+        log = rain.logpipe.LogPipe(os.path.join(name, 'Log-1'), compress=compress)
+        for stage in text.split('|'):
+            with log:
+                log.write(stage)
+        self.index.record(name, state='built', ended=time.time())
+
+    def testSearch(self):
+        self.build('a', 'compiling\nall good\n')
+        self.build('b', 'compiling\n|error: undefined reference to foo\n', compress='gzip')
+        self.build('c', 'error: undefined reference to foo\nok\n')
+        if shutil.which('zstd'):
+            os.remove(os.path.join('a', 'Log-1'))
+            with open(os.path.join('a', 'Log-1.zst'), 'wb') as f:
+                f.write(subprocess.run(['zstd', '-c'], input=b'old\nError: Undefined\n',
+                                       stdout=subprocess.PIPE).stdout)
+
+        nose.tools.assert_equal(3, self.logindex.update(self.index.rows()))
+        nose.tools.assert_equal(0, self.logindex.update(self.index.rows()))
+
+        nose.tools.assert_equal([('b', os.path.join('b', 'Log-1.gz'), 2, 'error: undefined reference to foo'),
+                                 ('c', os.path.join('c', 'Log-1'), 1, 'error: undefined reference to foo')],
+                                list(self.logindex.search('undefined reference')))
+        nose.tools.assert_equal('b', self.logindex.first_seen('error: undefined'))
+        nose.tools.assert_equal(None, self.logindex.first_seen('segfault'))
+        nose.tools.assert_equal(['c'], [hit[0] for hit in self.logindex.search('ok')])
+        if shutil.which('zstd'):
+            nose.tools.assert_equal('a', self.logindex.first_seen('Undefined'))
+
+        self.index.forget('b')
+        self.logindex.update(self.index.rows())
+        nose.tools.assert_equal('c', self.logindex.first_seen('error: undefined'))
+
+        with open(os.path.join('c', 'Log-2'), 'w') as f:
+            f.write('segfault\n')
+        self.index.record('c', ended=time.time() + 1)
+        nose.tools.assert_equal(1, self.logindex.update(self.index.rows()))
+        nose.tools.assert_equal('c', self.logindex.first_seen('segfault'))
+
+
+class testFingerprint:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testFingerprint(self):
+        index = rain.index.BuildIndex(':memory:')
+        tree = os.path.join(self.tmpdir, 'tree')
+        os.mkdir(tree)
+        with open(os.path.join(tree, 'file'), 'w') as f:
+            f.write('one\n')
+        with open(os.path.join(tree, '.rain'), 'w') as f:
+            f.write('incomplete\n')
+
+        first = rain.cache.fingerprint(tree, index, ignore=['.rain'])
+        nose.tools.assert_equal(first, rain.cache.fingerprint(tree, index, ignore=['.rain']))
+
+        with open(os.path.join(tree, '.rain'), 'w') as f:
+            f.write('populated\n')
+        nose.tools.assert_equal(first, rain.cache.fingerprint(tree, index, ignore=['.rain']))
+
+        with open(os.path.join(tree, 'file'), 'w') as f:
+            f.write('two\n')
+        nose.tools.assert_not_equal(first, rain.cache.fingerprint(tree, index, ignore=['.rain']))
+
+
+class testStageGraph:
+    def testParse(self):
+        nose.tools.assert_equal(None, rain.stages.parse(''))
+        nose.tools.assert_equal(None, rain.stages.parse('stages\n'))
+        graph = rain.stages.parse('populate:\ntest: build populate # comment\nbuild:\n')
+        nose.tools.assert_equal([('test', ['build']), ('build', [])], list(graph.items()))
+        nose.tools.assert_equal(['build', 'test'], rain.stages.order(graph))
+
+    def testBad(self):
+        nose.tools.assert_raises(rain.stages.StageError, rain.stages.parse, 'build:\nnonsense\n')
+        nose.tools.assert_raises(rain.stages.StageError, rain.stages.order, rain.stages.parse('a: b\n'))
+        nose.tools.assert_raises(rain.stages.StageError, rain.stages.order, rain.stages.parse('a: b\nb: a\n'))
+
+    def testKeys(self):
+        graph = rain.stages.parse('build:\nunit: build\nlint: build\n')
+        keys = rain.stages.keys(graph, 'abc')
+        nose.tools.assert_equal(3, len(set(keys.values())))
+        nose.tools.assert_equal(keys, rain.stages.keys(graph, 'abc'))
+        nose.tools.assert_not_equal(keys['unit'], rain.stages.keys(graph, 'abd')['unit'])
+
+    def testShards(self):
+        graph = rain.stages.parse('build:\ntest/8: build\npackage: test\n')
+        nose.tools.assert_equal({'test': 8}, graph.shards)
+        nose.tools.assert_equal(['build', 'test', 'package'], rain.stages.order(graph))
+        nose.tools.assert_raises(rain.stages.StageError, rain.stages.parse, 'test/0:\n')
+
+        nose.tools.assert_equal(8, rain.stages.shard_count(8, [], 60))
+        nose.tools.assert_equal(3, rain.stages.shard_count(8, [50, 60, 40], 60))
+        nose.tools.assert_equal(8, rain.stages.shard_count(8, [600, 600], 60))
+        nose.tools.assert_equal(1, rain.stages.shard_count(8, [1, 1], 60))
+        nose.tools.assert_equal(8, rain.stages.shard_count(8, [1, 1], None))
+
+
+class testBuildIndex:
+    def setup(self):
+        self.index = rain.index.BuildIndex(':memory:')
+
+    def testRecord(self):
+        nose.tools.assert_true(self.index.created)
+        self.index.record('b', state='built')
+        self.index.record('a', state='built')
+        self.index.record('c', state='populated')
+        nose.tools.assert_equal(['a', 'b', 'c'], self.index.names())
+        nose.tools.assert_equal('b', self.index.last('built'))
+        nose.tools.assert_equal(None, self.index.last('cached'))
+
+        self.index.record('c', state='built', exitcode=0)
+        nose.tools.assert_equal('c', self.index.last('built'))
+        nose.tools.assert_equal(0, self.index.get('c')['exitcode'])
+
+        self.index.forget('c')
+        nose.tools.assert_equal(None, self.index.get('c'))
+
+    @nose.tools.raises(KeyError)
+    def testBadColumn(self):
+        self.index.record('a', bogus=1)
+
+
+class testCloneTree:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testClone(self):
+        source = os.path.join(self.tmpdir, 'source')
+        destination = os.path.join(self.tmpdir, 'destination')
+        os.makedirs(os.path.join(source, 'sub'))
+        os.mkdir(destination)
+        for name in ['file', 'skip', os.path.join('sub', 'file')]:
+            with open(os.path.join(source, name), 'w') as f:
+                f.write(name)
+        os.symlink('file', os.path.join(source, 'link'))
+
+        method = rain.main.clone_tree(source, destination, ignore=['sk*'])
+        nose.tools.assert_in(method, ['reflink', 'hardlink', 'copy'])
+        nose.tools.assert_equal(['file', 'link', 'sub'], sorted(os.listdir(destination)))
+        nose.tools.assert_equal('file', os.readlink(os.path.join(destination, 'link')))
+        with open(os.path.join(destination, 'sub', 'file')) as f:
+            nose.tools.assert_equal(os.path.join('sub', 'file'), f.read())
+
+        shutil.rmtree(destination)
+        os.mkdir(destination)
+        method = rain.main.clone_tree(source, destination, methods=('reflink',))
+        nose.tools.assert_in(method, ['reflink', None])
+        if method is None:
+            nose.tools.assert_equal([], os.listdir(destination))
+
+
+class testReaper:
+    def setup(self):
+        self.savedir = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def teardown(self):
+        os.chdir(self.savedir)
+        shutil.rmtree(self.tmpdir)
+
+    def mktree(self, name):
+        os.makedirs(os.path.join(name, 'sub'))
+        os.symlink('sub', os.path.join(name, 'link'))
+        with open(os.path.join(name, 'sub', 'file'), 'w') as f:
+            f.write('file\n')
+
+    def testDiscard(self):
+        reaper = rain.main.Reaper(logger(), ionice=0)
+        reaper.start()
+        self.mktree('doomed')
+        reaper.discard('doomed')
+        nose.tools.assert_false(os.path.exists('doomed'))
+        reaper.stop()
+        nose.tools.assert_equal([], os.listdir(reaper.trash))
+
+    def testLeftovers(self):
+        os.mkdir('.rain-trash')
+        self.mktree(os.path.join('.rain-trash', 'leftover'))
+        reaper = rain.main.Reaper(logger(), ionice=0)
+        reaper.start()
+        reaper.stop()
+        nose.tools.assert_equal([], os.listdir(reaper.trash))
+
+
+class testWatcher:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def later(self, function):
+        timer = threading.Timer(0.1, function)
+        timer.start()
+        return timer
+
+    def testInitial(self):
+        watcher = rain.trigger.Watcher(logger(), touchfile=os.path.join(self.tmpdir, 'touch'))
+        nose.tools.assert_equal(set(['initial']), watcher.wait())
+
+    def testTouch(self):
+        touchfile = os.path.join(self.tmpdir, 'touch')
+        watcher = rain.trigger.Watcher(logger(), touchfile=touchfile, debounce=0.1)
+        watcher.tick = 0.05
+        watcher.wait()
+
+        self.later(lambda: open(touchfile, 'w').close()).join()
+        nose.tools.assert_equal(set([touchfile]), watcher.wait())
+
+    def testPaths(self):
+        watched = os.path.join(self.tmpdir, 'watched')
+        os.mkdir(watched)
+        watcher = rain.trigger.Watcher(logger(), paths=[watched], debounce=0.1)
+        watcher.wait()
+
+        def change():
+            for name in ['one', 'two']:
+                with open(os.path.join(watched, name), 'w') as f:
+                    f.write(name)
+
+        self.later(change)
+        reasons = watcher.wait()
+        nose.tools.assert_in(os.path.join(watched, 'one'), reasons)
+        nose.tools.assert_in(os.path.join(watched, 'two'), reasons)
+        watcher.close()
+
+    def testScanner(self):
+        scanner = rain.trigger.Scanner([self.tmpdir])
+        nose.tools.assert_equal([], scanner.read())
+        with open(os.path.join(self.tmpdir, 'new'), 'w') as f:
+            f.write('new')
+        nose.tools.assert_equal([os.path.join(self.tmpdir, 'new')], scanner.read())
+
+
+class testBench:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testSmall(self):
+        output = os.path.join(self.tmpdir, 'bench.json')
+        rain.bench.main(['--files', '10', '--builds', '2', '--many', '20', '--log-mb', '0.1',
+                         '--loops', '2', '--tmpdir', self.tmpdir, '-o', output])
+
+        with open(output) as f:
+            results = json.load(f)['results']
+
+        nose.tools.assert_equal(sorted(rain.bench.Bench.benchmarks), sorted(results))
+        nose.tools.assert_true(results['loop']['per_build'] > 0)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 K Richard Pixley
+
+"""
+Triggers which tell a watching build loop when to start the next
+build, rather than building continuously whether or not anything has
+changed.
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import shlex
+import struct
+import subprocess
+import time
+
+logger = logging.getLogger(__name__)
+
+class Inotify:
+    """
+    Recursive change watcher on linux inotify, through ctypes.  Raises
+    :py:exc:`OSError` where inotify isn't available.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+            | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    header = struct.Struct('iIII')
+
+    def __init__(self, paths):
+        libname = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'no inotify')
+
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+
+        self.watches = {}
+        for path in paths:
+            self.add_tree(path)
+
+    def close(self):
+        os.close(self.fd)
+
+    def fileno(self):
+        return self.fd
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch', path)
+
+        self.watches[wd] = path
+
+    def add_tree(self, path):
+        self.add(path)
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for name in dirnames:
+                    try:
+                        self.add(os.path.join(dirpath, name))
+                    except OSError as e:
+                        logger.debug('not watching %s: %s', os.path.join(dirpath, name), e)
+
+    def read(self):
+        """
+        Drain pending events, adding watches for new directories.
+
+        :return: list of changed paths.
+        """
+        changed = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return changed
+                raise
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = self.header.unpack_from(buf, offset)
+                offset += self.header.size
+                name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    changed.append('<overflow>')
+                    continue
+
+                if mask & self.IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+
+                path = os.path.join(self.watches.get(wd, ''), name)
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    try:
+                        self.add_tree(path)
+                    except OSError as e:
+                        logger.debug('not watching %s: %s', path, e)
+
+                changed.append(path)
+
+
+class Scanner:
+    """
+    Portable, slower stand in for :py:class:`Inotify` which compares
+    snapshots of modification times.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.snapshot = self.scan()
+
+    def close(self):
+        pass
+
+    def scan(self):
+        snapshot = {}
+        for path in self.paths:
+            for dirpath, dirnames, filenames in os.walk(path):
+                for name in dirnames + filenames:
+                    filename = os.path.join(dirpath, name)
+                    try:
+                        st = os.lstat(filename)
+                    except OSError:
+                        continue
+                    snapshot[filename] = (st.st_mtime_ns, st.st_size)
+
+            if os.path.isfile(path):
+                st = os.lstat(path)
+                snapshot[path] = (st.st_mtime_ns, st.st_size)
+
+        return snapshot
+
+    def read(self):
+        snapshot = self.scan()
+        changed = [path for path in set(snapshot) | set(self.snapshot)
+                   if snapshot.get(path) != self.snapshot.get(path)]
+        self.snapshot = snapshot
+        return changed
+
+
+class Watcher:
+    """
+    Blocks a build loop until something says a build is worthwhile.
+
+    Triggers are changes under any of *paths*, a change to the mtime of
+    *touchfile*, or the output of *pollcmd*, run every *interval*
+    seconds, containing the word "changed".  After the first trigger
+    :py:meth:`wait` keeps collecting triggers until there has been none
+    for *debounce* seconds, or for at most *maxdelay* seconds, so that a
+    burst of commits starts one build rather than many.
+
+    The first call to :py:meth:`wait` returns at once since we can't
+    know what changed while nobody was watching.
+    """
+
+    # how often to look at things which can't wake us up
+    tick = 1.0
+
+    def __init__(self, logger=logger, paths=(), touchfile=None, pollcmd=None, interval=60,
+                 debounce=5, maxdelay=None):
+        self.logger = logger
+        self.touchfile = touchfile
+        self.pollcmd = pollcmd
+        self.interval = interval
+        self.debounce = debounce
+        self.maxdelay = debounce * 10 if maxdelay is None else maxdelay
+        self.primed = False
+        self.next_poll = time.time() + interval
+        self.touched = self.touch_time()
+
+        self.watcher = None
+        if paths:
+            try:
+                self.watcher = Inotify(paths)
+            except OSError as e:
+                self.logger.info('inotify unavailable (%s), scanning for changes instead', e)
+                self.watcher = Scanner(paths)
+
+    def close(self):
+        if self.watcher:
+            self.watcher.close()
+
+    def touch_time(self):
+        try:
+            return os.stat(self.touchfile).st_mtime_ns if self.touchfile else None
+        except OSError:
+            return None
+
+    def poll(self):
+        cmd = shlex.split(self.pollcmd)
+        try:
+            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf-8', 'replace')
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.logger.error('%s failed: %s', self.pollcmd, e)
+            return False
+
+        return 'changed' in output.split()
+
+    def check(self, timeout):
+        """
+        Wait up to *timeout* seconds for a trigger.
+
+        :return: list of reasons, empty if nothing happened.
+        """
+        reasons = []
+        now = time.time()
+        if self.pollcmd:
+            timeout = max(0, min(timeout, self.next_poll - now))
+
+        if self.touchfile or (self.watcher and not isinstance(self.watcher, Inotify)):
+            timeout = min(timeout, self.tick)
+
+        if isinstance(self.watcher, Inotify):
+            ready, _, _ = select.select([self.watcher], [], [], timeout)
+            if ready:
+                reasons.extend(self.watcher.read())
+        else:
+            time.sleep(timeout)
+            if self.watcher:
+                reasons.extend(self.watcher.read())
+
+        touched = self.touch_time()
+        if touched != self.touched:
+            self.touched = touched
+            reasons.append(self.touchfile)
+
+        if self.pollcmd and time.time() >= self.next_poll:
+            self.next_poll = time.time() + self.interval
+            if self.poll():
+                reasons.append(self.pollcmd)
+
+        return reasons
+
+    def wait(self):
+        """
+        Block until triggered and quiet again.
+
+        :return: the set of reasons for the build.
+        """
+        if not self.primed:
+            self.primed = True
+            return set(['initial'])
+
+        reasons = set()
+        while not reasons:
+            reasons.update(self.check(3600))
+
+        self.logger.debug('triggered by %s, debouncing', ', '.join(sorted(reasons)))
+        start = time.time()
+        quiet = start
+        while True:
+            now = time.time()
+            remaining = min(quiet + self.debounce, start + self.maxdelay) - now
+            if remaining <= 0:
+                break
+
+            more = self.check(remaining)
+            if more:
+                reasons.update(more)
+                quiet = time.time()
+
+        self.logger.info('triggered by %s', ', '.join(sorted(reasons)))
+        return reasons
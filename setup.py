@@ -81,7 +81,7 @@ setuptools.setup(
         ],
     entry_points = {
         'console_scripts': [
-            'rain = rain.main:main',
+            'rain = rain.daemon:main',
         ],
         # 'gui_scripts': [
         #     'baz = my_package_gui.start_func',